@@ -1,12 +1,18 @@
 import os
 import logging
 import csv
-import threading
+import sys
 from datetime import datetime, timedelta
-from typing import Dict, List
+from typing import Dict, List, Optional
 import asyncio
 import time
 import base64   
+import hashlib
+import gzip
+import json
+import socket
+
+from cachetools import LRUCache, TTLCache
 
 from telegram import (
     Update,
@@ -22,12 +28,24 @@ from telegram.ext import (
     CallbackQueryHandler,
     ContextTypes,
     filters,
-    ConversationHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
 )
 
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 
+from search import ArchiveSearchIndex, SearchIndex
+from sheets_sync import SheetsSync
+from sla import SLATracker
+from state import (
+    AppStatus,
+    ApplicationRecord,
+    create_backend,
+    record_from_dict,
+    record_to_dict,
+)
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -43,38 +61,110 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SPREADSHEET_NAME = "Telegram zayavki"
 REMINDER_INTERVAL = 300  # 5 минут в секундах
+SLA_CONFIG_PATH = 'sla.json'
+# Пороги SLA по умолчанию в секундах; для автопарков переопределяются в sla.json
+SLA_DEFAULT_THRESHOLDS = {
+    'accept': REMINDER_INTERVAL,
+    'resolve': 4 * 3600,
+}
+SLA_ESCALATION_LADDER = ['technician', 'dispatcher', 'admin']
+SLA_CHECK_INTERVAL = 1
+# Лимиты запросов: (емкость корзины, пополнение токенов в секунду)
+USER_RATE_LIMIT = (20, 1)
+COMMAND_RATE_LIMITS = {
+    'activeapplications': (3, 1 / 10),
+    'allapplication': (3, 1 / 10),
+    'roles': (2, 1 / 30),
+    'report': (3, 1 / 10),
+    'history': (5, 1 / 5),
+    'search': (10, 1 / 2),
+    'exportlogs': (1, 1 / 60),
+}
+COMMAND_DEDUP_WINDOW = 2  # одинаковая команда от пользователя чаще раза в 2 секунды отбрасывается
+RATE_LIMIT_NOTICE_INTERVAL = 10  # не чаще одного предупреждения о лимите в 10 секунд
+ERROR_DIGEST_INTERVAL = 60  # ошибки отправляются админам сводкой раз в минуту
+CHAT_NAME_CACHE_TTL = 600
 ADMIN_IDS = [1132625886, 886922044]  # ID админов
-
-# Состояния для ConversationHandler
-ENTERING_SOLUTION, ENTERING_PHOTO = range(2)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")  # memory / sqlite:///state.db / redis://host:6379/0
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}"
+LEADER_LEASE_TTL = 30  # секунд; лидер продлевает аренду каждые LEADER_LEASE_TTL / 3
+SHEETS_FLUSH_INTERVAL = 10
+SHEETS_PULL_INTERVAL = 60  # как часто проверять ревизию таблицы на ручные правки
+SHEETS_MAX_BACKOFF = 600  # предельная пауза между попытками, пока Google Sheets недоступен
+SHEETS_WORKSHEET = "Заявки"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # при наличии обновления принимаются вебхуком вместо polling
+ARCHIVE_DIR = 'archive'
+ARCHIVE_INDEX_PATH = os.path.join(ARCHIVE_DIR, 'index.json')
+ARCHIVE_SEARCH_PATH = os.path.join(ARCHIVE_DIR, 'search.db')  # поисковый индекс архива на диске
+ARCHIVE_ID_PATH = os.path.join(ARCHIVE_DIR, 'archive_id')  # тот же идентификатор хранится в общем хранилище
+ARCHIVE_ID_TTL = 100 * 365 * 24 * 3600  # аренда 'archive_id' — бессрочная привязка архива к каталогу
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 30))  # через сколько дней решенная заявка уходит в архив
+ARCHIVE_INTERVAL = 24 * 3600  # запуск архивации раз в сутки
+ARCHIVE_CACHE_SIZE = 256  # сколько архивных заявок держать в памяти после подгрузки
+SEARCH_PAGE_SIZE = 5
+SEARCH_QUERY_TTL = 24 * 3600  # сколько живут кнопки листания результатов поиска
+SEARCH_SYNC_INTERVAL = 60  # как часто каждый экземпляр дочитывает журнал 'search' и отмечает свою позицию
+SEARCH_READER_TTL = 600  # экземпляр, не отмечавшийся дольше, считается остановленным и не держит журнал
+# Вес совпадения по полю при ранжировании результатов поиска
+SEARCH_FIELD_WEIGHTS = {
+    'serial': 5,
+    'bus': 5,
+    'phone': 4,
+    'garage': 2,
+    'problem': 1,
+    'solution': 1,
+}
 
 # Инициализация глобальных переменных
-users_roles = {}  # {user_id: 'admin'/'dispatcher'/'technician'}
-applications = {}  # {application_id: application_data}
-current_applications = {}  # {technician_id: application_id}s
-application_counter = 0
-pending_notifications = {}  # {application_id: timer_thread}
-statistics = {
-    'total_applications': 0,
-    'resolved_applications': 0,
-    'avg_resolution_time': 0,
-    'technician_stats': {},
-    'dispatcher_stats': {}
-}
+backend = create_backend(STATE_BACKEND)
+users_roles = backend.users_roles  # {user_id: 'admin'/'dispatcher'/'technician'}
+applications = backend.applications  # {application_id: ApplicationRecord}
+current_applications = backend.current_applications  # {technician_id: application_id}
+is_leader = False  # держит ли этот экземпляр аренду лидера (таймеры, выгрузка в Sheets, архив)
+# Индекс архива: {'ids': {application_id: segment}, 'serial': {serial: [ids]}, 'bus': {bus: [ids]}}.
+# Архив один на все экземпляры: при запуске на нескольких машинах ARCHIVE_DIR должен быть общим
+# каталогом (сетевой ФС с блокировками), иначе архивные заявки видны только на одной машине.
+# Архивирует только лидер, остальные перечитывают index.json, когда меняется время его изменения
+archive_index = {'ids': {}, 'serial': {}, 'bus': {}}
+archive_available = False  # совпадает ли ARCHIVE_DIR с каталогом, в котором начат архив
+archive_index_mtime = None
+archive_cache = LRUCache(maxsize=ARCHIVE_CACHE_SIZE)  # {application_id: ApplicationRecord}
+
+
+search_index = SearchIndex(SEARCH_FIELD_WEIGHTS)  # текущие заявки; архив подключается при запуске
+search_log_offset = 0  # позиция в общем журнале 'search' с id заявок, проиндексированных любым экземпляром
+
+
+sla_tracker = SLATracker(applications, SLA_DEFAULT_THRESHOLDS, len(SLA_ESCALATION_LADDER))
+
+
+inflight_requests = {}  # {ключ запроса: asyncio.Task}
+chat_names = TTLCache(maxsize=1024, ttl=CHAT_NAME_CACHE_TTL)  # {user_id: имя}
+error_digest = {}  # ошибки этого экземпляра до передачи лидеру: {описание: [количество, последний источник]}
+sheets_failures = 0  # подряд неудачных обращений к Google Sheets
+sheets_retry_at = 0.0  # раньше этого времени к Google Sheets не обращаемся
 
 # Инициализация Google Sheets
-scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-creds_json = base64.b64decode(os.getenv("GOOGLE_CREDENTIALS")).decode()
-creds = ServiceAccountCredentials.from_json_keyfile_dict(eval(creds_json), scope)
+gs_client = None
 
 
+def get_gs_client():
+    """Авторизуется в Google при первом обращении, чтобы модуль импортировался без ключей"""
+    global gs_client
+    if gs_client is None:
+        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+        creds_json = base64.b64decode(os.getenv("GOOGLE_CREDENTIALS")).decode()
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(eval(creds_json), scope)
+        gs_client = gspread.authorize(creds)
+    return gs_client
 
-def get_worksheet():
+def get_spreadsheet():
     try:
-        return gs_client.open(SPREADSHEET_NAME).sheet1
+        return get_gs_client().open(SPREADSHEET_NAME)
     except gspread.SpreadsheetNotFound:
-        worksheet = gs_client.create(SPREADSHEET_NAME)
-        return worksheet.sheet1
+        return get_gs_client().create(SPREADSHEET_NAME)
+
+sheets_sync = SheetsSync(get_spreadsheet, backend, SHEETS_WORKSHEET)
 
 def log_action(user_id: int, action: str, details: str = "") -> None:
     """Логирование действий пользователей"""
@@ -86,84 +176,490 @@ def log_action(user_id: int, action: str, details: str = "") -> None:
     except Exception as e:
         logger.error(f"Ошибка при записи лога: {e}")
 
-def start_notification_timer(app_id: str, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Запускает таймер для уведомления о непринятой заявке"""
-    def notify_technicians():
-        time.sleep(REMINDER_INTERVAL)
-        if app_id in applications and applications[app_id]['status'] == 'active':
-            technicians = [uid for uid, role in users_roles.items() if role == 'technician']
-            for tech_id in technicians:
-                try:
-                    context.bot.send_message(
-                        chat_id=tech_id,
-                        text=f"⚠️ Заявка №{app_id} все еще ожидает принятия!\n"
-                             f"Проблема: {applications[app_id]['problem']}"
-                    )
-                    log_action(tech_id, 'reminder_sent', f'application_{app_id}')
-                except Exception as e:
-                    logger.error(f"Не удалось отправить напоминание технику {tech_id}: {e}")
-    
-    thread = threading.Thread(target=notify_technicians)
-    thread.start()
-    pending_notifications[app_id] = thread
+async def leader_election_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Берет или продлевает аренду лидера; задачи по расписанию выполняет только лидер"""
+    global is_leader
+    try:
+        leader = backend.acquire_lease('leader', INSTANCE_ID, LEADER_LEASE_TTL)
+    except Exception as e:
+        logger.error(f"Ошибка продления аренды лидера: {e}")
+        leader = False
+    if leader != is_leader:
+        logger.info(f"Экземпляр {INSTANCE_ID} {'стал лидером' if leader else 'больше не лидер'}")
+        # Пока экземпляр не был лидером, таблицу и заявки мог менять другой
+        sheets_sync.reset()
+        sla_tracker.reset()
+    is_leader = leader
+
+async def sla_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Продвигает колесо сроков SLA и эскалирует просроченные заявки"""
+    if not is_leader:
+        return
+    sla_tracker.ensure_loaded()
+    for app_id in dict.fromkeys(backend.pop_queue('sla', 1000)):
+        app = applications.get(app_id)
+        if app is None:
+            sla_tracker.wheel.cancel(app_id)
+        else:
+            sla_tracker.refresh(app)
+    
+    wheel = sla_tracker.wheel
+    for app, phase, level in sla_tracker.due():
+        # Пока шла эскалация, экземпляр мог потерять лидерство: тогда колесо сброшено,
+        # а оставшиеся сроки заново запланирует новый лидер
+        if not is_leader or sla_tracker.wheel is not wheel:
+            return
+
+        def bump_level(record, phase=phase, level=level):
+            # Пока шла эскалация предыдущих заявок, эту могли принять или уже эскалировать
+            if SLATracker.phase(record)[0] != phase or record.sla_level != level:
+                return False
+            record.sla_level = level + 1
+            return True
+
+        updated = backend.update_application(app.id, bump_level)
+        if updated is None:
+            fresh = applications.get(app.id)
+            if fresh is None:
+                sla_tracker.wheel.cancel(app.id)
+            else:
+                sla_tracker.refresh(fresh)
+            continue
+        sla_tracker.refresh(updated)
+        if level == 0:
+            record_sla_breach(updated, phase)
+        await escalate(context, updated, phase, SLA_ESCALATION_LADDER[level])
+
+async def escalate(context: ContextTypes.DEFAULT_TYPE, app: ApplicationRecord, phase: str, role: str) -> None:
+    """Уведомляет очередную ступень о просроченной заявке"""
+    if role == 'admin':
+        recipients = ADMIN_IDS
+    elif role == 'technician' and phase == 'resolve':
+        recipients = [app.technician_id]
+    else:
+        recipients = [uid for uid, user_role in users_roles.items() if user_role == role]
+    
+    overdue = int(time.time()) - SLATracker.phase(app)[1]
+    if phase == 'accept':
+        text = (f"⚠️ Заявка №{app.id} все еще ожидает принятия ({overdue // 60} мин.)!\n"
+                f"Автопарк: {app.garage}\n"
+                f"Проблема: {app.problem}")
+    else:
+        text = (f"⚠️ Заявка №{app.id} не решена {overdue // 60} мин.!\n"
+                f"Техник: {app.technician_name}\n"
+                f"Автопарк: {app.garage}\n"
+                f"Проблема: {app.problem}")
+    
+    for user_id in recipients:
+        try:
+            await context.bot.send_message(chat_id=user_id, text=text)
+            log_action(user_id, 'sla_escalation', f'application_{app.id}_{phase}_{role}')
+        except Exception as e:
+            logger.error(f"Не удалось отправить эскалацию SLA {user_id}: {e}")
+
+def sheets_failed(operation: str, error: Exception) -> None:
+    """Откладывает следующие обращения к Google Sheets с экспоненциальной паузой и сообщает админам через сводку ошибок"""
+    global sheets_failures, sheets_retry_at
+    sheets_failures += 1
+    delay = min(SHEETS_FLUSH_INTERVAL * 2 ** (sheets_failures - 1), SHEETS_MAX_BACKOFF)
+    sheets_retry_at = time.time() + delay
+    logger.error(f"Ошибка {operation} Google Таблицы (попытка {sheets_failures}, следующая через {delay} сек.): {error}")
+    sheets_sync.reset()
+    report_error(f"Google Sheets, ошибка {operation}: {type(error).__name__}: {error}", 'sheets')
+
+def sheets_recovered() -> None:
+    global sheets_failures, sheets_retry_at
+    if sheets_failures:
+        logger.info(f"Google Sheets снова доступен после {sheets_failures} неудачных попыток")
+    sheets_failures, sheets_retry_at = 0, 0.0
+
+async def sheets_flush_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выгружает изменившиеся заявки из общей очереди в Google Sheets"""
+    if not is_leader or time.time() < sheets_retry_at:
+        return
+    app_ids = list(dict.fromkeys(backend.pop_queue('sheets', 100)))
+    if not app_ids:
+        return
+    apps = [app for app in (get_application(app_id) for app_id in app_ids) if app is not None]
+    try:
+        sheets_sync.push(apps)
+    except Exception as e:
+        for app_id in app_ids:
+            backend.push_queue('sheets', app_id)
+        sheets_failed('записи', e)
+        return
+    sheets_recovered()
+
+async def sheets_pull_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Переносит ручные правки из Google Sheets в заявки"""
+    if not is_leader or time.time() < sheets_retry_at:
+        return
+    try:
+        changed = sheets_sync.pull()
+    except Exception as e:
+        sheets_failed('чтения', e)
+        return
+    sheets_recovered()
+    for app in changed:
+        index_application(app)
+        log_action('sheets', 'application_edited_in_sheet', f'application_{app.id}')
 
 def update_statistics(app_id: str, action: str) -> None:
-    """Обновляет статистику на основе действий с заявками"""
+    """Обновляет статистику на основе действий с заявками.
+
+    Счетчики и суммы времени хранятся в общем хранилище, чтобы отчет учитывал заявки всех экземпляров;
+    средние считаются при формировании отчета.
+    """
     app = applications[app_id]
     
     if action == 'created':
-        statistics['total_applications'] += 1
-        
-        # Обновляем статистику диспетчера
-        dispatcher_id = app['dispatcher_id']
-        if dispatcher_id not in statistics['dispatcher_stats']:
-            statistics['dispatcher_stats'][dispatcher_id] = {'created': 0}
-        statistics['dispatcher_stats'][dispatcher_id]['created'] += 1
+        backend.incr_stats({'created': 1, f'created:dispatcher:{app.dispatcher_id}': 1})
+    
+    elif action == 'accepted':
+        accept_time = (app.accepted_at - app.created_at) / 60  # в минутах
+        backend.incr_stats({'accepted': 1, 'accept_minutes': accept_time})
     
     elif action == 'resolved':
-        statistics['resolved_applications'] += 1
-        
         # Рассчитываем время решения
-        created_time = datetime.strptime(app['created_time'], '%Y-%m-%d %H:%M:%S')
-        resolved_time = datetime.strptime(app['resolved_time'], '%Y-%m-%d %H:%M:%S')
-        resolution_time = (resolved_time - created_time).total_seconds() / 60  # в минутах
-        
-        # Обновляем общее среднее время
-        total_time = statistics['avg_resolution_time'] * (statistics['resolved_applications'] - 1)
-        statistics['avg_resolution_time'] = (total_time + resolution_time) / statistics['resolved_applications']
-        
-        # Обновляем статистику техника
-        technician_id = app['technician_id']
-        if technician_id not in statistics['technician_stats']:
-            statistics['technician_stats'][technician_id] = {'resolved': 0, 'avg_time': 0}
-        
-        tech_stats = statistics['technician_stats'][technician_id]
-        total_tech_time = tech_stats['avg_time'] * tech_stats['resolved']
-        tech_stats['resolved'] += 1
-        tech_stats['avg_time'] = (total_tech_time + resolution_time) / tech_stats['resolved']
+        resolution_time = (app.resolved_at - app.created_at) / 60  # в минутах
+        backend.incr_stats({
+            'resolved': 1,
+            'resolve_minutes': resolution_time,
+            f'resolved:technician:{app.technician_id}': 1,
+            f'resolve_minutes:technician:{app.technician_id}': resolution_time,
+        })
+
+def record_sla_breach(app: ApplicationRecord, phase: str) -> None:
+    """Учитывает нарушение срока принятия или решения заявки"""
+    backend.incr_stats({f'sla_breaches:{phase}': 1, f'garage_breaches:{phase}:{app.garage}': 1})
+    log_action('system', 'sla_breach', f'application_{app.id}_{phase}')
 
 def generate_report() -> str:
     """Генерирует текстовый отчет со статистикой"""
+    stats = backend.get_stats()
+    total = int(stats.get('created', 0))
+    resolved = int(stats.get('resolved', 0))
+    accepted = int(stats.get('accepted', 0))
     report = "📊 Статистика работы системы:\n\n"
     
-    report += f"Всего заявок: {statistics['total_applications']}\n"
-    if statistics['total_applications'] > 0:
-        report += f"Решено заявок: {statistics['resolved_applications']} ({statistics['resolved_applications']/statistics['total_applications']*100:.1f}%)\n"
+    report += f"Всего заявок: {total}\n"
+    if total > 0:
+        report += f"Решено заявок: {resolved} ({resolved/total*100:.1f}%)\n"
     else:
         report += "Решено заявок: 0 (0%)\n"
     
-    report += f"Среднее время решения: {statistics['avg_resolution_time']:.1f} мин.\n\n"
+    report += f"Среднее время решения: {stats.get('resolve_minutes', 0) / max(resolved, 1):.1f} мин.\n"
+    report += f"Среднее время принятия: {stats.get('accept_minutes', 0) / max(accepted, 1):.1f} мин.\n\n"
+    
+    report += "⏱ Нарушения SLA:\n"
+    report += f"- срок принятия: {int(stats.get('sla_breaches:accept', 0))}\n"
+    report += f"- срок решения: {int(stats.get('sla_breaches:resolve', 0))}\n"
+    garage_breaches = {}  # {garage: {'accept': n, 'resolve': n}}
+    for name, count in stats.items():
+        if name.startswith('garage_breaches:'):
+            _, phase, garage = name.split(':', 2)
+            garage_breaches.setdefault(garage, {'accept': 0, 'resolve': 0})[phase] = int(count)
+    for garage, garage_stats in garage_breaches.items():
+        report += f"- {garage}: принятие {garage_stats['accept']}, решение {garage_stats['resolve']}\n"
+    report += "\n"
     
     report += "📌 Статистика диспетчеров:\n"
-    for disp_id, stats in statistics['dispatcher_stats'].items():
-        report += f"- ID {disp_id}: создано {stats['created']} заявок\n"
+    for name, created in stats.items():
+        if name.startswith('created:dispatcher:'):
+            report += f"- ID {name.rsplit(':', 1)[1]}: создано {int(created)} заявок\n"
     
     report += "\n🔧 Статистика техников:\n"
-    for tech_id, stats in statistics['technician_stats'].items():
-        report += f"- ID {tech_id}: решено {stats['resolved']} заявок, среднее время {stats['avg_time']:.1f} мин.\n"
+    for name, tech_resolved in stats.items():
+        if name.startswith('resolved:technician:'):
+            tech_id = name.rsplit(':', 1)[1]
+            avg_time = stats.get(f'resolve_minutes:technician:{tech_id}', 0) / tech_resolved
+            report += f"- ID {tech_id}: решено {int(tech_resolved)} заявок, среднее время {avg_time:.1f} мин.\n"
     
     return report
 
+def archive_segment_path(segment: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f'{segment}.jsonl.gz')
+
+def check_archive_dir() -> bool:
+    """Проверяет, что ARCHIVE_DIR — тот же каталог, в котором другие экземпляры ведут архив.
+
+    Идентификатор архива лежит и в файле каталога, и в общем хранилище (как аренда без срока).
+    Экземпляр с другим каталогом не архивирует: иначе появился бы второй index.json,
+    а заявки, перенесенные в него, пропали бы для остальных экземпляров.
+    """
+    global archive_available
+    try:
+        with open(ARCHIVE_ID_PATH, encoding='utf-8') as f:
+            archive_id = f.read().strip()
+    except FileNotFoundError:
+        archive_id = None
+    if archive_id is not None:
+        archive_available = backend.acquire_lease('archive_id', archive_id, ARCHIVE_ID_TTL)
+    else:
+        archive_id = hashlib.sha1(f'{INSTANCE_ID}:{time.time()}'.encode()).hexdigest()
+        archive_available = backend.acquire_lease('archive_id', archive_id, ARCHIVE_ID_TTL)
+        if archive_available:
+            with open(ARCHIVE_ID_PATH, 'w', encoding='utf-8') as f:
+                f.write(archive_id)
+    if not archive_available:
+        logger.error(f"Каталог {ARCHIVE_DIR} не общий с другими экземплярами: архивирование на этом экземпляре "
+                     f"отключено, архивные заявки не будут найдены. Подключите общий каталог архива")
+    return archive_available
+
+def load_archive_index() -> None:
+    """Загружает индекс архива и продолжает нумерацию заявок после архивных"""
+    if not refresh_archive_index():
+        return
+    if archive_index['ids']:
+        backend.ensure_counter(max(int(i) for i in archive_index['ids']))
+
+def refresh_archive_index() -> bool:
+    """Перечитывает index.json, если его обновил лидер. Возвращает True, если индекс перечитан"""
+    global archive_index, archive_index_mtime
+    try:
+        mtime = os.stat(ARCHIVE_INDEX_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    if mtime == archive_index_mtime:
+        return False
+    try:
+        with open(ARCHIVE_INDEX_PATH, encoding='utf-8') as f:
+            archive_index = json.load(f)
+    except Exception as e:
+        logger.error(f"Ошибка чтения индекса архива: {e}")
+        return False
+    archive_index_mtime = mtime
+    # Заявки, которые лидер перенес в архив, ищутся по индексу архива
+    for app_id in archive_index['ids']:
+        search_index.remove(app_id)
+    return True
+
+def save_archive_index() -> None:
+    global archive_index_mtime
+    tmp_path = ARCHIVE_INDEX_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(archive_index, f, ensure_ascii=False)
+    os.replace(tmp_path, ARCHIVE_INDEX_PATH)
+    archive_index_mtime = os.stat(ARCHIVE_INDEX_PATH).st_mtime_ns
+
+def archive_resolved_applications(now: Optional[int] = None) -> int:
+    """Переносит давно закрытые заявки в месячные сегменты архива и удаляет их фото с диска"""
+    refresh_archive_index()
+    now = int(time.time()) if now is None else now
+    threshold = now - ARCHIVE_AFTER_DAYS * 24 * 3600
+    busy = set(current_applications.values())
+    stale = [app for app in applications.values()
+             if app.status.is_closed and app.resolved_at <= threshold and app.id not in busy]
+    if not stale:
+        return 0
+
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    # Фото удаляется с диска, поэтому в архив и в таблицу путь не попадает — остается file_id в Telegram
+    photo_paths = []
+    for app in stale:
+        if app.photo:
+            photo_paths.append(app.photo)
+            app.photo = None
+
+    # Заявки, записанные в архив прошлым запуском, который упал до удаления их из хранилища,
+    # повторно в сегмент и индекс не пишутся — иначе история показала бы их дважды
+    by_segment = {}
+    for app in stale:
+        if app.id in archive_index['ids']:
+            continue
+        segment = datetime.fromtimestamp(app.resolved_at).strftime('%Y-%m')
+        by_segment.setdefault(segment, []).append(app)
+
+    for segment, apps in by_segment.items():
+        # gzip допускает дозапись: каждый запуск добавляет новый member в конец сегмента
+        with gzip.open(archive_segment_path(segment), 'at', encoding='utf-8') as f:
+            for app in apps:
+                f.write(json.dumps(record_to_dict(app), ensure_ascii=False) + '\n')
+        for app in apps:
+            archive_index['ids'][app.id] = segment
+            archive_index['serial'].setdefault(app.serial, []).append(app.id)
+            archive_index['bus'].setdefault(app.bus, []).append(app.id)
+    save_archive_index()
+    search_index.archive.add_many(stale)
+
+    for app in stale:
+        applications.pop(app.id, None)
+        search_index.remove(app.id)
+        backend.push_queue('sheets', app.id)
+    for photo_path in photo_paths:
+        if os.path.exists(photo_path):
+            try:
+                os.remove(photo_path)
+            except OSError as e:
+                logger.error(f"Не удалось удалить фото {photo_path}: {e}")
+    logger.info(f"В архив перенесено заявок: {len(stale)}")
+    return len(stale)
+
+def load_archived_applications(app_ids: List[str]) -> List[ApplicationRecord]:
+    """Подгружает архивные заявки, читая каждый нужный сегмент один раз"""
+    refresh_archive_index()
+    result = {}
+    by_segment = {}
+    for app_id in app_ids:
+        if app_id in archive_cache:
+            result[app_id] = archive_cache[app_id]
+        elif app_id in archive_index['ids']:
+            by_segment.setdefault(archive_index['ids'][app_id], set()).add(app_id)
+
+    for segment, wanted in by_segment.items():
+        try:
+            with gzip.open(archive_segment_path(segment), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    data = json.loads(line)
+                    if data['id'] in wanted:
+                        app = record_from_dict(data)
+                        archive_cache[app.id] = app
+                        result[app.id] = app
+        except Exception as e:
+            logger.error(f"Ошибка чтения сегмента архива {segment}: {e}")
+
+    return [result[app_id] for app_id in app_ids if app_id in result]
+
+def get_application(app_id: str) -> Optional[ApplicationRecord]:
+    """Возвращает заявку из оперативной памяти или из архива"""
+    if app_id in applications:
+        return applications[app_id]
+    found = load_archived_applications([app_id])
+    return found[0] if found else None
+
+def find_applications(field: str, value: str) -> List[ApplicationRecord]:
+    """Ищет заявки по серийному номеру или госномеру, включая архив"""
+    hot = [app for app in applications.values() if getattr(app, field) == value]
+    refresh_archive_index()
+    hot_ids = {app.id for app in hot}
+    archived = load_archived_applications([app_id for app_id in archive_index[field].get(value, [])
+                                           if app_id not in hot_ids])
+    return sorted(hot + archived, key=lambda app: app.created_at)
+
+def index_application(app: ApplicationRecord) -> None:
+    """Индексирует заявку и сообщает о ней остальным экземплярам через общий журнал"""
+    search_index.add(app)
+    backend.append_log('search', app.id)
+
+def sync_search_index() -> None:
+    """Переиндексирует заявки, которые создали или изменили другие экземпляры"""
+    global search_log_offset
+    reader = f'search:{INSTANCE_ID}'
+    if reader not in backend.log_readers:
+        # Экземпляр долго не отмечался, и лидер мог удалить непрочитанные записи — переиндексируем все
+        search_log_offset = backend.log_end('search')
+        for app in applications.values():
+            search_index.add(app)
+    else:
+        search_log_offset, app_ids = backend.read_log('search', search_log_offset)
+        for app_id in dict.fromkeys(app_ids):
+            app = applications.get(app_id)
+            if app is not None:
+                search_index.add(app)
+            # Заявки, ушедшие в архив, уже есть в индексе архива
+    backend.log_readers[reader] = f'{search_log_offset} {int(time.time())}'
+
+def trim_search_log() -> None:
+    """Удаляет из журнала 'search' записи, которые прочитали все работающие экземпляры"""
+    now = time.time()
+    positions = []
+    for reader, value in list(backend.log_readers.items()):
+        if not reader.startswith('search:'):
+            continue
+        offset, seen_at = map(int, value.split())
+        if now - seen_at > SEARCH_READER_TTL:
+            backend.log_readers.pop(reader, None)
+        else:
+            positions.append(offset)
+    if positions:
+        backend.trim_log('search', min(positions))
+
+async def search_sync_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        sync_search_index()
+        if is_leader:
+            trim_search_log()
+    except Exception as e:
+        logger.error(f"Ошибка синхронизации поискового индекса: {e}")
+
+def rebuild_search_index() -> None:
+    """Строит индекс текущих заявок и дописывает в индекс архива заявки, которых в нем нет"""
+    global search_log_offset
+    # Позиция журнала запоминается до чтения заявок, чтобы не пропустить изменения во время построения
+    search_log_offset = backend.log_end('search')
+    backend.log_readers[f'search:{INSTANCE_ID}'] = f'{search_log_offset} {int(time.time())}'
+    search_index.archive = ArchiveSearchIndex(ARCHIVE_SEARCH_PATH, SEARCH_FIELD_WEIGHTS)
+    # Токены архива хранятся на диске; сегменты читаются, только если search.db отстал от index.json
+    missing = set(archive_index['ids']) - search_index.archive.indexed_ids()
+    segments = sorted({archive_index['ids'][app_id] for app_id in missing})
+    for segment in segments:
+        try:
+            with gzip.open(archive_segment_path(segment), 'rt', encoding='utf-8') as f:
+                search_index.archive.add_many(
+                    app for app in (record_from_dict(json.loads(line)) for line in f) if app.id in missing)
+        except Exception as e:
+            logger.error(f"Ошибка индексации сегмента архива {segment}: {e}")
+    for app in applications.values():
+        search_index.add(app)
+    logger.info(f"Поисковый индекс построен: {len(search_index.doc_tokens)} текущих заявок, "
+                f"{len(missing)} архивных дописано")
+
+async def archive_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not is_leader or not archive_available:
+        return
+    try:
+        archive_resolved_applications()
+    except Exception as e:
+        logger.error(f"Ошибка архивации заявок: {e}")
+
+async def coalesce(key, factory):
+    """Одновременные одинаковые запросы ждут один общий результат вместо повторного выполнения"""
+    task = inflight_requests.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        inflight_requests[key] = task
+        task.add_done_callback(lambda _: inflight_requests.pop(key, None))
+    # shield: отмена одного ожидающего не отменяет запрос для остальных
+    return await asyncio.shield(task)
+
+async def rate_limit_middleware(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ограничивает частоту запросов пользователя и отдельных команд (группа обработчиков -1).
+
+    Корзины токенов и отсев повторов хранятся в общем хранилище, поэтому лимит действует
+    на пользователя целиком, на какой бы экземпляр ни пришло обновление.
+    """
+    user = update.effective_user
+    if user is None:
+        return
+    # Уникальный владелец коротких аренд: повторное обновление — уже другой update_id
+    owner = f"{INSTANCE_ID}:{update.update_id}"
+    
+    command = None
+    message = update.message
+    if message and message.text and message.text.startswith('/'):
+        command = message.text.split()[0][1:].split('@')[0].lower()
+        if not backend.acquire_lease(f"dedup:{user.id}:{message.text.strip()[:200]}", owner, COMMAND_DEDUP_WINDOW):
+            # Повтор той же команды, пока предыдущий ответ еще в пути
+            raise ApplicationHandlerStop
+    
+    wait = backend.take_token(f"user:{user.id}", *USER_RATE_LIMIT)
+    if not wait and command in COMMAND_RATE_LIMITS:
+        wait = backend.take_token(f"command:{user.id}:{command}", *COMMAND_RATE_LIMITS[command])
+    if not wait:
+        return
+    
+    log_action(user.id, 'rate_limited', command or '')
+    if backend.acquire_lease(f"rate_notice:{user.id}", owner, RATE_LIMIT_NOTICE_INTERVAL):
+        text = f"⏳ Слишком много запросов. Попробуйте через {int(wait) + 1} сек."
+        try:
+            if update.callback_query:
+                await update.callback_query.answer(text)
+            elif message:
+                await message.reply_text(text)
+        except Exception as e:
+            logger.error(f"Не удалось предупредить о лимите {user.id}: {e}")
+    raise ApplicationHandlerStop
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id in ADMIN_IDS and user_id not in users_roles:
@@ -196,6 +692,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /roles - все роли с именами
 /activeapplications - активные заявки
 /allapplication - все заявки за день
+/history - история заявок по серийному номеру или госномеру
+/search - поиск по всем заявкам
 /report - статистика работы
 /exportlogs - экспорт логов действий
         """
@@ -204,6 +702,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 Команды диспетчера:
 /activeapplications - активные заявки
 /allapplication - все заявки за день
+/history - история заявок по серийному номеру или госномеру
+/search - поиск по всем заявкам
 /report - статистика работы
         """
     elif role == 'technician':
@@ -296,6 +796,23 @@ async def remove_dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except (IndexError, ValueError):
         await update.message.reply_text("Использование: /removedispatcher <user_id>")
 
+async def build_roles_message(bot) -> str:
+    """Список ролей с именами; имена кэшируются, чтобы не запрашивать get_chat каждый раз"""
+    message = "Список ролей:\n"
+    for role_user_id, role in users_roles.items():
+        if role_user_id not in chat_names:
+            try:
+                user = await bot.get_chat(role_user_id)
+                chat_names[role_user_id] = user.first_name
+            except:
+                chat_names[role_user_id] = None
+        name = chat_names[role_user_id]
+        if name:
+            message += f"{name} (ID: {role_user_id}) - {role}\n"
+        else:
+            message += f"ID: {role_user_id} - {role}\n"
+    return message
+
 async def list_roles(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in ADMIN_IDS and users_roles.get(user_id) != 'admin':
@@ -306,72 +823,196 @@ async def list_roles(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Нет назначенных ролей.")
         return
     
-    message = "Список ролей:\n"
-    for user_id, role in users_roles.items():
-        try:
-            user = await context.bot.get_chat(user_id)
-            message += f"{user.first_name} (ID: {user_id}) - {role}\n"
-        except:
-            message += f"ID: {user_id} - {role}\n"
-    
+    message = await coalesce('roles', lambda: build_roles_message(context.bot))
     await update.message.reply_text(message)
     log_action(user_id, 'list_roles_viewed')
 
-async def active_applications(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if user_id not in users_roles:
-        await update.message.reply_text('Вы не авторизованы.')
-        return
-    
-    active_apps = [app for app in applications.values() if app['status'] == 'active']
+def build_active_applications_message() -> str:
+    # Выполняется в потоке: list() снимает копию словаря в памяти за один шаг
+    active_apps = [app for app in list(applications.values()) if app.status is AppStatus.ACTIVE]
     
     if not active_apps:
-        await update.message.reply_text('Нет активных заявок.')
-        return
+        return 'Нет активных заявок.'
     
     text = "Активные заявки:\n\n"
     for app in active_apps:
-        text += f"Заявка №{app['id']}\n"
-        text += f"Сер. номер: {app['serial']}\n"
-        text += f"Гос. номер: {app['bus']}\n"
-        text += f"Автопарк: {app['garage']}\n"
-        text += f"Водитель: {app['phone']}\n"
-        text += f"Проблема: {app['problem']}\n"
-        text += f"Время создания: {app['created_time']}\n\n"
+        text += f"Заявка №{app.id}\n"
+        text += f"Сер. номер: {app.serial}\n"
+        text += f"Гос. номер: {app.bus}\n"
+        text += f"Автопарк: {app.garage}\n"
+        text += f"Водитель: {app.phone}\n"
+        text += f"Проблема: {app.problem}\n"
+        text += f"Время создания: {app.created_time}\n\n"
+    return text
+
+async def active_applications(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in users_roles:
+        await update.message.reply_text('Вы не авторизованы.')
+        return
     
+    # Ответ одинаков для всех ролей: одновременные запросы делят одно чтение заявок из хранилища,
+    # а само чтение идет в потоке, чтобы не блокировать цикл событий
+    text = await coalesce('activeapplications', lambda: asyncio.to_thread(build_active_applications_message))
     await update.message.reply_text(text)
     log_action(user_id, 'viewed_active_applications')
 
+def build_today_applications_message(midnight: datetime) -> str:
+    today = midnight.strftime('%Y-%m-%d')
+    since = int(midnight.timestamp())
+    today_apps = [app for app in list(applications.values()) if app.created_at >= since]
+    
+    if not today_apps:
+        return 'Сегодня не было заявок.'
+    
+    text = f"Все заявки за {today}:\n\n"
+    for app in today_apps:
+        text += f"Заявка №{app.id} ({app.status.label})\n"
+        text += f"Сер. номер: {app.serial}\n"
+        text += f"Гос. номер: {app.bus}\n"
+        text += f"Автопарк: {app.garage}\n"
+        text += f"Водитель: {app.phone}\n"
+        text += f"Проблема: {app.problem}\n"
+        if app.status.is_closed:
+            text += f"Решение: {app.solution}\n"
+            text += f"Техник: {app.technician_name}\n"
+            text += f"Время решения: {app.resolved_time}\n"
+        text += "\n"
+    return text
+
 async def all_applications(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in users_roles:
         await update.message.reply_text('Вы не авторизованы.')
         return
     
-    today = datetime.now().strftime('%Y-%m-%d')
-    today_apps = [app for app in applications.values() if app['created_time'].startswith(today)]
+    midnight = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    text = await coalesce(('allapplication', midnight),
+                          lambda: asyncio.to_thread(build_today_applications_message, midnight))
+    await update.message.reply_text(text)
+    log_action(user_id, 'viewed_all_applications')
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in users_roles or users_roles[user_id] not in ['admin', 'dispatcher']:
+        await update.message.reply_text('Эта команда только для админа и диспетчеров.')
+        return
     
-    if not today_apps:
-        await update.message.reply_text('Сегодня не было заявок.')
+    if not context.args:
+        await update.message.reply_text("Использование: /history <серийный номер или госномер>")
         return
     
-    text = f"Все заявки за {today}:\n\n"
-    for app in today_apps:
-        status = "Активная" if app['status'] == 'active' else "Решена"
-        text += f"Заявка №{app['id']} ({status})\n"
-        text += f"Сер. номер: {app['serial']}\n"
-        text += f"Гос. номер: {app['bus']}\n"
-        text += f"Автопарк: {app['garage']}\n"
-        text += f"Водитель: {app['phone']}\n"
-        text += f"Проблема: {app['problem']}\n"
-        if app['status'] == 'resolved':
-            text += f"Решение: {app['solution']}\n"
-            text += f"Техник: {app['technician_name']}\n"
-            text += f"Время решения: {app['resolved_time']}\n"
+    value = ' '.join(context.args)
+    apps = find_applications('serial', value) or find_applications('bus', value)
+    if not apps:
+        await update.message.reply_text('Заявки не найдены.')
+        return
+    
+    text = f"История заявок по «{value}»:\n\n"
+    for app in apps:
+        text += f"Заявка №{app.id} ({app.status.label})\n"
+        text += f"Сер. номер: {app.serial}\n"
+        text += f"Гос. номер: {app.bus}\n"
+        text += f"Автопарк: {app.garage}\n"
+        text += f"Проблема: {app.problem}\n"
+        text += f"Время создания: {app.created_time}\n"
+        if app.status.is_closed:
+            text += f"Решение: {app.solution}\n"
+            text += f"Техник: {app.technician_name}\n"
+            text += f"Время решения: {app.resolved_time}\n"
         text += "\n"
     
     await update.message.reply_text(text)
-    log_action(user_id, 'viewed_all_applications')
+    log_action(user_id, 'viewed_history', value)
+
+def search_query_key(query: str) -> str:
+    """Короткий ключ запроса для callback_data (не больше 64 байт); сам запрос хранится в общем хранилище
+    SEARCH_QUERY_TTL секунд с последнего показа страницы"""
+    key = hashlib.sha1(query.encode()).hexdigest()[:12]
+    backend.put_expiring(f'search:{key}', query, SEARCH_QUERY_TTL)
+    return key
+
+def render_search_page(query: str, page: int):
+    """Формирует текст и кнопки навигации для страницы результатов поиска"""
+    sync_search_index()
+    skipped = set()
+    while True:
+        app_ids = [app_id for app_id in search_index.search(query) if app_id not in skipped]
+        if not app_ids:
+            return f"По запросу «{query}» ничего не найдено.", None
+        
+        pages = (len(app_ids) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+        page = max(0, min(page, pages - 1))
+        page_ids = app_ids[page * SEARCH_PAGE_SIZE:(page + 1) * SEARCH_PAGE_SIZE]
+        hot = [applications[app_id] for app_id in page_ids if app_id in applications]
+        archived = load_archived_applications([app_id for app_id in page_ids if app_id not in applications])
+        found = {app.id: app for app in hot + archived}
+        missing = [app_id for app_id in page_ids if app_id not in found]
+        if not missing:
+            break
+        # Заявки нет ни в хранилище, ни в архиве — убираем ее из индекса и пересчитываем страницы,
+        # чтобы число найденных совпадало с выводом. Индекс архива не трогаем: сегмент мог не прочитаться
+        skipped.update(missing)
+        for app_id in missing:
+            search_index.remove(app_id)
+    
+    text = f"Найдено заявок: {len(app_ids)} (стр. {page + 1}/{pages})\n\n"
+    for app_id in page_ids:
+        app = found[app_id]
+        text += f"Заявка №{app.id} ({app.status.label})\n"
+        text += f"Сер. номер: {app.serial}\n"
+        text += f"Гос. номер: {app.bus}\n"
+        text += f"Автопарк: {app.garage}\n"
+        text += f"Водитель: {app.phone}\n"
+        text += f"Проблема: {app.problem}\n"
+        text += f"Время создания: {app.created_time}\n"
+        if app.status.is_closed:
+            text += f"Решение: {app.solution}\n"
+            text += f"Техник: {app.technician_name}\n"
+        text += "\n"
+    
+    buttons = []
+    # Запрос передается в кнопке: у пользователя может быть открыто несколько поисков сразу
+    key = search_query_key(query) if pages > 1 else None
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"search:{page - 1}:{key}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"search:{page + 1}:{key}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in users_roles or users_roles[user_id] not in ['admin', 'dispatcher']:
+        await update.message.reply_text('Эта команда только для админа и диспетчеров.')
+        return
+    
+    if not context.args:
+        await update.message.reply_text("Использование: /search <серийный номер, госномер, телефон, автопарк или текст проблемы>")
+        return
+    
+    query = ' '.join(context.args)
+    text, keyboard = render_search_page(query, 0)
+    await update.message.reply_text(text, reply_markup=keyboard)
+    log_action(user_id, 'search', query)
+
+async def handle_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user_id = query.from_user.id
+    if user_id not in users_roles or users_roles[user_id] not in ['admin', 'dispatcher']:
+        await query.edit_message_text('Эта команда только для админа и диспетчеров.')
+        return
+    
+    # Кнопки старого формата (search:<страница>) ключа запроса не содержат
+    parts = query.data.split(":", 2)
+    search_query = backend.get_expiring(f'search:{parts[2]}') if len(parts) == 3 else None
+    if not search_query:
+        await query.edit_message_text("Поиск устарел, повторите /search.")
+        return
+    
+    page = int(parts[1])
+    text, keyboard = render_search_page(search_query, page)
+    await query.edit_message_text(text, reply_markup=keyboard)
 
 async def my_applications(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -379,7 +1020,7 @@ async def my_applications(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('Эта команда только для техников.')
         return
     
-    my_apps = [app for app in applications.values() if app.get('technician_id') == user_id and app['status'] == 'resolved']
+    my_apps = [app for app in applications.values() if app.technician_id == user_id and app.status.is_closed]
     
     if not my_apps:
         await update.message.reply_text('У вас нет выполненных заявок.')
@@ -387,14 +1028,14 @@ async def my_applications(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     text = "Ваши выполненные заявки:\n\n"
     for app in my_apps:
-        text += f"Заявка №{app['id']}\n"
-        text += f"Сер. номер: {app['serial']}\n"
-        text += f"Гос. номер: {app['bus']}\n"
-        text += f"Автопарк: {app['garage']}\n"
-        text += f"Водитель: {app['phone']}\n"
-        text += f"Проблема: {app['problem']}\n"
-        text += f"Решение: {app['solution']}\n"
-        text += f"Время решения: {app['resolved_time']}\n\n"
+        text += f"Заявка №{app.id}\n"
+        text += f"Сер. номер: {app.serial}\n"
+        text += f"Гос. номер: {app.bus}\n"
+        text += f"Автопарк: {app.garage}\n"
+        text += f"Водитель: {app.phone}\n"
+        text += f"Проблема: {app.problem}\n"
+        text += f"Решение: {app.solution}\n"
+        text += f"Время решения: {app.resolved_time}\n\n"
     
     await update.message.reply_text(text)
     log_action(user_id, 'viewed_my_applications')
@@ -412,13 +1053,13 @@ async def current_application(update: Update, context: ContextTypes.DEFAULT_TYPE
     app_id = current_applications[user_id]
     app = applications[app_id]
     
-    text = f"Текущая заявка №{app['id']}:\n"
-    text += f"Сер. номер: {app['serial']}\n"
-    text += f"Гос. номер: {app['bus']}\n"
-    text += f"Автопарк: {app['garage']}\n"
-    text += f"Водитель: {app['phone']}\n"
-    text += f"Проблема: {app['problem']}\n"
-    text += f"Время создания: {app['created_time']}\n"
+    text = f"Текущая заявка №{app.id}:\n"
+    text += f"Сер. номер: {app.serial}\n"
+    text += f"Гос. номер: {app.bus}\n"
+    text += f"Автопарк: {app.garage}\n"
+    text += f"Водитель: {app.phone}\n"
+    text += f"Проблема: {app.problem}\n"
+    text += f"Время создания: {app.created_time}\n"
     
     await update.message.reply_text(text)
     log_action(user_id, 'viewed_current_application', f'application_{app_id}')
@@ -442,30 +1083,25 @@ async def handle_dispatcher_message(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text("❗ Неполные данные. Нужно: серийный номер, проблема, телефон водителя, госномер, автопарк.")
         return
 
-    global application_counter
-    application_counter += 1
-    app_id = str(application_counter)
-    
-    applications[app_id] = {
-        "id": app_id,
-        "serial": data["серийный номер"],
-        "problem": data["проблема"],
-        "phone": data["телефон водителя"],
-        "bus": data["госномер"],
-        "garage": data["автопарк"],
-        "status": "active",
-        "created_time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        "dispatcher_id": user_id,
-        "dispatcher_name": update.effective_user.full_name,
-        "technician_id": None,
-        "technician_name": None,
-        "solution": None,
-        "photo": None,
-        "resolved_time": None
-    }
+    app_id = str(backend.next_application_id())
+    
+    applications[app_id] = ApplicationRecord(
+        id=app_id,
+        serial=data["серийный номер"],
+        problem=data["проблема"],
+        phone=data["телефон водителя"],
+        bus=data["госномер"],
+        garage=data["автопарк"],
+        dispatcher_id=user_id,
+        dispatcher_name=update.effective_user.full_name,
+        created_at=int(time.time()),
+    )
     
     log_action(user_id, 'application_created', f'application_{app_id}')
     update_statistics(app_id, 'created')
+    index_application(applications[app_id])
+    backend.push_queue('sheets', app_id)
+    backend.push_queue('sla', app_id)
     
     text_message = (
         f"📥 *Новая заявка #{app_id}*\n"
@@ -501,10 +1137,6 @@ async def handle_dispatcher_message(update: Update, context: ContextTypes.DEFAUL
     else:
         await update.message.reply_text("❌ Не удалось отправить заявку техникам. Нет доступных техников.")
 
-    # Настраиваем напоминание
-    if technicians:
-        start_notification_timer(app_id, context)
-
 async def handle_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -515,28 +1147,35 @@ async def handle_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     action, app_id = query.data.split(":")
-    if app_id not in applications or applications[app_id]['status'] != 'active':
+    app = applications.get(app_id)
+    if app is None or app.status is not AppStatus.ACTIVE:
         await query.edit_message_text("❌ Заявка уже обработана.")
         return
     
-    applications[app_id]['status'] = 'in_progress'
-    applications[app_id]['technician_id'] = user_id
-    applications[app_id]['technician_name'] = query.from_user.full_name
-    current_applications[user_id] = app_id
-    
-    # Отменяем напоминание
-    if app_id in pending_notifications:
-        pending_notifications[app_id].join()
-        del pending_notifications[app_id]
-    
-    log_action(user_id, 'application_accepted', f'application_{app_id}')
-    
     if action == "accept":
-        keyboard = InlineKeyboardMarkup([[
-            InlineKeyboardButton("🟢 Решено", callback_data=f"resolved:{app_id}"),
-            InlineKeyboardButton("🔴 Не решено", callback_data=f"unresolved:{app_id}")
-        ]])
-        await query.edit_message_text("✅ Вы приняли заявку. Укажи статус:", reply_markup=keyboard)
+        def accept(record):
+            # Заявку могут одновременно принять на разных экземплярах бота — побеждает первый
+            if record.status is not AppStatus.ACTIVE:
+                return False
+            record.transition(AppStatus.IN_PROGRESS)
+            record.technician_id = user_id
+            record.technician_name = sys.intern(query.from_user.full_name)
+            record.accepted_at = int(time.time())
+            record.sla_level = 0
+            return True
+        
+        app = backend.update_application(app_id, accept)
+        if app is None:
+            await query.edit_message_text("❌ Заявка уже обработана.")
+            return
+        current_applications[user_id] = app_id
+        update_statistics(app_id, 'accepted')
+        backend.push_queue('sheets', app_id)
+        backend.push_queue('sla', app_id)
+        
+        log_action(user_id, 'application_accepted', f'application_{app_id}')
+        
+        await query.edit_message_text("✅ Вы приняли заявку. Укажи статус:", reply_markup=status_keyboard(app_id))
         
         # Уведомляем диспетчеров
         dispatchers = [uid for uid, role in users_roles.items() if role == 'dispatcher']
@@ -581,49 +1220,107 @@ async def handle_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     
     action, app_id = query.data.split(":")
-    if app_id not in applications or applications[app_id]['technician_id'] != user_id:
+    app = applications.get(app_id)
+    if app is None or app.technician_id != user_id:
         await query.edit_message_text("❌ Вы не назначены на эту заявку.")
         return
     
-    applications[app_id]['status'] = "Решено" if action == "resolved" else "Не решено"
+    if app.status is not AppStatus.IN_PROGRESS:
+        await query.edit_message_text("❌ Заявка уже обработана.")
+        return
+    
+    def set_outcome(record):
+        if record.status is not AppStatus.IN_PROGRESS or record.technician_id != user_id:
+            return False
+        record.outcome = AppStatus.RESOLVED if action == "resolved" else AppStatus.UNRESOLVED
+        record.solution = None  # при повторном выборе статуса решение вводится заново
+        return True
+    
+    if backend.update_application(app_id, set_outcome) is None:
+        await query.edit_message_text("❌ Заявка уже обработана.")
+        return
     await query.edit_message_text("✍️ Опиши, как ты решил проблему:")
-    return ENTERING_SOLUTION
+
+class TechnicianStepFilter(filters.MessageFilter):
+    """Шаг завершения заявки определяется по самой заявке техника, а не по состоянию диалога в памяти,
+    поэтому следующее сообщение может обработать любой экземпляр бота"""
+
+    def __init__(self, step: str):
+        super().__init__(name=f'TechnicianStepFilter({step})')
+        self.step = step
+
+    def filter(self, message) -> bool:
+        if message.from_user is None:
+            return False
+        app_id = current_applications.get(message.from_user.id)
+        app = applications.get(app_id) if app_id is not None else None
+        return app is not None and technician_step(app) == self.step
+
+def technician_step(app: ApplicationRecord) -> Optional[str]:
+    """Чего бот ждет от техника по заявке: 'solution', 'photo' или None"""
+    if app.status is not AppStatus.IN_PROGRESS or app.outcome is None:
+        return None
+    return 'solution' if app.solution is None else 'photo'
+
+def status_keyboard(app_id: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("🟢 Решено", callback_data=f"resolved:{app_id}"),
+        InlineKeyboardButton("🔴 Не решено", callback_data=f"unresolved:{app_id}")
+    ]])
 
 async def enter_solution(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in current_applications:
+    app_id = current_applications.get(user_id)
+    if app_id is None:
         await update.message.reply_text('У вас нет активной заявки.')
-        return ConversationHandler.END
+        return
     
-    app_id = current_applications[user_id]
-    applications[app_id]['solution'] = update.message.text
+    
+    def set_solution(record):
+        if technician_step(record) != 'solution':
+            return False
+        record.solution = update.message.text
+        return True
+    
+    if backend.update_application(app_id, set_solution) is None:
+        await update.message.reply_text('❌ Заявка уже обработана.')
+        return
     log_action(user_id, 'solution_entered', f'application_{app_id}')
     
     await update.message.reply_text('📸 Теперь отправьте фото как подтверждение.')
-    return ENTERING_PHOTO
 
 async def enter_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in current_applications:
+    app_id = current_applications.get(user_id)
+    if app_id is None:
         await update.message.reply_text('У вас нет активной заявки.')
-        return ConversationHandler.END
-    
-    app_id = current_applications[user_id]
-    application = applications[app_id]
+        return
     
     # Получаем фото
     photo_file = await update.message.photo[-1].get_file()
+    photo_file_id = update.message.photo[-1].file_id
     photo_path = f'photos/application_{app_id}.jpg'
     os.makedirs('photos', exist_ok=True)
     await photo_file.download_to_drive(photo_path)
     
     # Обновляем статус заявки
-    application['status'] = 'resolved'
-    application['resolved_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    application['photo'] = photo_path
+    def close(record):
+        if technician_step(record) != 'photo':
+            return False
+        record.transition(record.outcome)
+        record.resolved_at = int(time.time())
+        record.photo = photo_path
+        record.photo_file_id = photo_file_id
+        return True
+    
+    application = backend.update_application(app_id, close)
+    if application is None:
+        await update.message.reply_text('❌ Заявка уже обработана.')
+        return
     
     log_action(user_id, 'photo_uploaded', f'application_{app_id}')
     update_statistics(app_id, 'resolved')
+    index_application(application)
     
     # Удаляем заявку из текущих
     del current_applications[user_id]
@@ -632,13 +1329,13 @@ async def enter_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     caption = (
         f"📄 Заявка #{app_id} выполнена\n"
         f"🧑‍🔧 Техник: {update.message.from_user.full_name}\n"
-        f"📟 Серийный: {application['serial']}\n"
-        f"📞 Телефон водителя: {application['phone']}\n"
-        f"🚌 Госномер: {application['bus']}\n"
-        f"🏢 Автопарк: {application['garage']}\n"
-        f"📆 Дата: {application['resolved_time']}\n"
-        f"⚙️ Статус: {application['status']}\n"
-        f"📝 Решение: {application['solution']}")
+        f"📟 Серийный: {application.serial}\n"
+        f"📞 Телефон водителя: {application.phone}\n"
+        f"🚌 Госномер: {application.bus}\n"
+        f"🏢 Автопарк: {application.garage}\n"
+        f"📆 Дата: {application.resolved_time}\n"
+        f"⚙️ Статус: {application.status.label}\n"
+        f"📝 Решение: {application.solution}")
 
     dispatchers = [uid for uid, role in users_roles.items() if role == 'dispatcher']
     for disp_id in dispatchers:
@@ -651,32 +1348,11 @@ async def enter_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception as e:
             logger.error(f"Ошибка отправки фото диспетчеру {disp_id}: {e}")
 
-    # Сохраняем в Google Sheets
-    try:
-        worksheet = get_worksheet()
-        worksheet.append_row([
-            application['created_time'],
-            application['serial'],
-            application['bus'],
-            application['garage'],
-            application['phone'],
-            application['problem'],
-            application['status'],
-            application['solution'],
-            application['resolved_time'],
-            application['dispatcher_name'],
-            application['technician_name'],
-            photo_path
-        ])
-    except Exception as e:
-        logger.error(f"Ошибка записи в Google Таблицу: {e}")
-        await context.bot.send_message(
-            chat_id=ADMIN_IDS[0],
-            text=f"Ошибка при записи заявки №{app_id} в Google Sheets: {e}"
-        )
+    # Обновляем строку в Google Sheets и снимаем сроки SLA (выполняет экземпляр-лидер)
+    backend.push_queue('sheets', app_id)
+    backend.push_queue('sla', app_id)
 
     await update.message.reply_text("✅ Заявка завершена. Спасибо!")
-    return ConversationHandler.END
 
 async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -705,11 +1381,23 @@ async def export_logs_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text(f'Ошибка при экспорте логов: {e}')
         logger.error(f"Ошибка при экспорте логов: {e}")
 
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
+    app_id = current_applications.get(user_id)
+    
+    def reset_outcome(record):
+        if technician_step(record) is None:
+            return False
+        record.outcome = None
+        record.solution = None
+        return True
+    
     log_action(user_id, 'operation_cancelled')
+    if app_id is not None and backend.update_application(app_id, reset_outcome) is not None:
+        await update.message.reply_text('Действие отменено. Укажи статус заявки заново:',
+                                        reply_markup=status_keyboard(app_id))
+        return
     await update.message.reply_text('Действие отменено.')
-    return ConversationHandler.END
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error("Исключение при обработке обновления:", exc_info=context.error)
@@ -717,19 +1405,65 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     if update and update.effective_user:
         log_action(update.effective_user.id if update else 'system', 'error_occurred', str(context.error))
         
-        for admin_id in ADMIN_IDS:
-            try:
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=f"Произошла ошибка при обработке сообщения от {update.effective_user.id}: {context.error}"
-                )
-            except Exception as e:
-                logger.error(f"Не удалось отправить сообщение об ошибке админу {admin_id}: {e}")
+        report_error(f"{type(context.error).__name__}: {context.error}", update.effective_user.id)
+
+def report_error(description: str, source) -> None:
+    """Добавляет ошибку в сводку: админам уходит сообщение раз в ERROR_DIGEST_INTERVAL, а не на каждую ошибку"""
+    entry = error_digest.setdefault(description[:200], [0, None])
+    entry[0] += 1
+    entry[1] = source
+
+async def error_digest_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Передает ошибки экземпляра в общую очередь; лидер отправляет админам одну сводку за все экземпляры"""
+    if error_digest:
+        entries = [[description, count, source] for description, (count, source) in error_digest.items()]
+        try:
+            backend.push_queue('errors', json.dumps(entries, ensure_ascii=False))
+        except Exception as e:
+            # Хранилище недоступно — об этом админы должны узнать, пусть и от каждого экземпляра
+            logger.error(f"Не удалось передать сводку ошибок лидеру: {e}")
+            digest = dict(error_digest)
+            error_digest.clear()
+            await send_error_digest(context, digest)
+            return
+        error_digest.clear()
+    if not is_leader:
+        return
+    
+    digest = {}
+    for value in backend.pop_queue('errors', 1000):
+        for description, count, source in json.loads(value):
+            entry = digest.setdefault(description, [0, None])
+            entry[0] += count
+            entry[1] = source
+    if digest:
+        await send_error_digest(context, digest)
+
+async def send_error_digest(context: ContextTypes.DEFAULT_TYPE, digest: Dict[str, list]) -> None:
+    entries = sorted(digest.items(), key=lambda item: -item[1][0])
+    total = sum(count for count, _ in digest.values())
+    
+    text = f"⚠️ Ошибок за последние {ERROR_DIGEST_INTERVAL} сек.: {total}\n\n"
+    for key, (count, last_source) in entries[:20]:
+        text += f"×{count} {key} (последний источник {last_source})\n"
+    if len(entries) > 20:
+        text += f"...и еще {len(entries) - 20} видов ошибок\n"
+    
+    for admin_id in ADMIN_IDS:
+        try:
+            await context.bot.send_message(chat_id=admin_id, text=text[:4000])
+        except Exception as e:
+            logger.error(f"Не удалось отправить сводку ошибок админу {admin_id}: {e}")
 
 def main():
     # Создаем папки для хранения данных
     os.makedirs('photos', exist_ok=True)
     os.makedirs('logs', exist_ok=True)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    check_archive_dir()
+    load_archive_index()
+    sla_tracker.load_config(SLA_CONFIG_PATH)
+    rebuild_search_index()
     
     # Инициализируем файл логов
     if not os.path.exists('user_actions.csv'):
@@ -741,9 +1475,13 @@ def main():
     for admin_id in ADMIN_IDS:
         users_roles[admin_id] = 'admin'
 
-    # Создаем Application
+    # Создаем Application. Шаги техника восстанавливаются по заявке в общем хранилище,
+    # поэтому persistence не нужен и обновления может обрабатывать любой экземпляр
     app = Application.builder().token(BOT_TOKEN).build()
 
+    # Ограничение частоты запросов до всех остальных обработчиков
+    app.add_handler(TypeHandler(Update, rate_limit_middleware), group=-1)
+
     # Обработчики команд
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
@@ -754,33 +1492,51 @@ def main():
     app.add_handler(CommandHandler("roles", list_roles))
     app.add_handler(CommandHandler("activeapplications", active_applications))
     app.add_handler(CommandHandler("allapplication", all_applications))
+    app.add_handler(CommandHandler("history", history_command))
+    app.add_handler(CommandHandler("search", search_command))
     app.add_handler(CommandHandler("myapplications", my_applications))
     app.add_handler(CommandHandler("activeapplication", current_application))
     app.add_handler(CommandHandler("report", report_command))
     app.add_handler(CommandHandler("exportlogs", export_logs_command))
 
+    # Обработчики решения заявок техниками — раньше обработчика диспетчеров, чтобы перехватить ответ техника
+    app.add_handler(CallbackQueryHandler(handle_status, pattern="^(resolved|unresolved):"))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & TechnicianStepFilter('solution'), enter_solution))
+    app.add_handler(MessageHandler(filters.PHOTO & TechnicianStepFilter('photo'), enter_photo))
+    app.add_handler(CommandHandler('cancel', cancel))
+
     # Обработчик сообщений от диспетчеров
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(users_roles.get('dispatcher', [])), handle_dispatcher_message))
 
     # Обработчик кнопок для техников
     app.add_handler(CallbackQueryHandler(handle_response, pattern="^(accept|reject):"))
-
-    # Обработчик решения заявок техниками
-    tech_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(handle_status, pattern="^(resolved|unresolved):")],
-        states={
-            ENTERING_SOLUTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, enter_solution)],
-            ENTERING_PHOTO: [MessageHandler(filters.PHOTO, enter_photo)],
-        },
-        fallbacks=[CommandHandler('cancel', cancel)],
-    )
-    app.add_handler(tech_conv_handler)
+    app.add_handler(CallbackQueryHandler(handle_search_page, pattern="^search:"))
 
     # Обработчик ошибок
     app.add_error_handler(error_handler)
+    app.job_queue.run_repeating(error_digest_job, interval=ERROR_DIGEST_INTERVAL, first=ERROR_DIGEST_INTERVAL)
+
+    # Выбор лидера и задачи, которые выполняет только лидер
+    app.job_queue.run_repeating(leader_election_job, interval=LEADER_LEASE_TTL / 3, first=0)
+    app.job_queue.run_repeating(sla_job, interval=SLA_CHECK_INTERVAL, first=SLA_CHECK_INTERVAL)
+    app.job_queue.run_repeating(sheets_flush_job, interval=SHEETS_FLUSH_INTERVAL, first=SHEETS_FLUSH_INTERVAL)
+    app.job_queue.run_repeating(sheets_pull_job, interval=SHEETS_PULL_INTERVAL, first=SHEETS_PULL_INTERVAL)
+    # Периодическая архивация решенных заявок
+    app.job_queue.run_repeating(archive_job, interval=ARCHIVE_INTERVAL, first=60)
+    app.job_queue.run_repeating(search_sync_job, interval=SEARCH_SYNC_INTERVAL, first=SEARCH_SYNC_INTERVAL)
 
     logger.info("🤖 Бот запущен!")
 
+    # С вебхуком несколько экземпляров за балансировщиком делят входящие обновления
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", 8000)),
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+        )
+        return
+
      # Для Railway (чтобы не крашилось из-за отсутствия веб-сервера)
     if "RAILWAY_ENVIRONMENT" in os.environ:
         import threading
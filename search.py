@@ -0,0 +1,186 @@
+"""Полнотекстовый поиск по заявкам"""
+import re
+import sqlite3
+from typing import Dict, Iterable, List, Optional
+
+from state import ApplicationRecord
+
+
+class SearchIndex:
+    """Инкрементальный инвертированный индекс по текущим заявкам в памяти.
+
+    postings: {токен: {application_id: вес}}, trigrams: {триграмма: {токен}} —
+    триграммы позволяют находить токены по префиксу и подстроке без перебора словаря.
+    Если задан archive, поиск объединяет результаты с индексом архива на диске.
+    """
+
+    def __init__(self, field_weights: Dict[str, int], archive: Optional['ArchiveSearchIndex'] = None):
+        self.field_weights = field_weights  # {поле заявки: вес совпадения}
+        self.archive = archive
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.trigrams: Dict[str, set] = {}
+        self.doc_tokens: Dict[str, tuple] = {}  # {application_id: токены документа}
+
+    @staticmethod
+    def tokenize(text: Optional[str]) -> List[str]:
+        return re.findall(r'\w+', text.lower()) if text else []
+
+    @staticmethod
+    def token_trigrams(token: str) -> set:
+        return {token[i:i + 3] for i in range(len(token) - 2)}
+
+    def document_tokens(self, app: ApplicationRecord) -> Dict[str, int]:
+        tokens = {}
+        for field, weight in self.field_weights.items():
+            value = getattr(app, field)
+            words = self.tokenize(value)
+            # Номера ищем и целиком, без пробелов и дефисов: «123 ABC 02» -> «123abc02»
+            if field in ('serial', 'bus', 'phone') and len(words) > 1:
+                words.append(''.join(words))
+            for word in words:
+                tokens[word] = max(tokens.get(word, 0), weight)
+        return tokens
+
+    def add(self, app: ApplicationRecord) -> None:
+        """Индексирует заявку; повторный вызов переиндексирует ее"""
+        self.remove(app.id)
+        tokens = self.document_tokens(app)
+        for token, weight in tokens.items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = {}
+                for trigram in self.token_trigrams(token):
+                    self.trigrams.setdefault(trigram, set()).add(token)
+            posting[app.id] = weight
+        self.doc_tokens[app.id] = tuple(tokens)
+
+    def remove(self, app_id: str) -> None:
+        for token in self.doc_tokens.pop(app_id, ()):
+            posting = self.postings[token]
+            posting.pop(app_id, None)
+            if not posting:
+                del self.postings[token]
+                for trigram in self.token_trigrams(token):
+                    self.trigrams[trigram].discard(token)
+                    if not self.trigrams[trigram]:
+                        del self.trigrams[trigram]
+
+    def has_token(self, token: str) -> bool:
+        return token in self.postings
+
+    def trigram_candidates(self, trigrams: set) -> set:
+        """Токены словаря, содержащие все триграммы"""
+        candidates = None
+        for trigram in trigrams:
+            tokens = self.trigrams.get(trigram, set())
+            candidates = tokens if candidates is None else candidates & tokens
+            if not candidates:
+                return set()
+        return candidates
+
+    def token_postings(self, token: str) -> Dict[str, int]:
+        return self.postings[token]
+
+    def matching_tokens(self, term: str) -> Dict[str, float]:
+        """Токены словаря, подходящие под слово запроса, с множителем релевантности"""
+        matches = {}
+        if self.has_token(term):
+            matches[term] = 1.0
+        if len(term) < 3:
+            return matches
+        for token in self.trigram_candidates(self.token_trigrams(term)):
+            if token == term:
+                continue
+            if token.startswith(term):
+                matches[token] = 0.7
+            elif term in token:
+                matches[token] = 0.4
+        return matches
+
+    def term_scores(self, term: str) -> Dict[str, float]:
+        """Лучшая оценка совпадения слова запроса для каждой заявки"""
+        term_scores = {}
+        for token, factor in self.matching_tokens(term).items():
+            for app_id, weight in self.token_postings(token).items():
+                score = weight * factor
+                if score > term_scores.get(app_id, 0):
+                    term_scores[app_id] = score
+        return term_scores
+
+    def search(self, query: str) -> List[str]:
+        """Возвращает id заявок, содержащих все слова запроса, по убыванию релевантности"""
+        scores = None
+        for term in set(self.tokenize(query)):
+            term_scores = self.term_scores(term)
+            if self.archive is not None:
+                # Заявка, еще не убранная из памяти после архивации, учитывается один раз
+                for app_id, score in self.archive.term_scores(term).items():
+                    if score > term_scores.get(app_id, 0):
+                        term_scores[app_id] = score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {app_id: score + term_scores[app_id]
+                          for app_id, score in scores.items() if app_id in term_scores}
+            if not scores:
+                return []
+        if not scores:
+            return []
+        # При равной релевантности — сначала новые заявки
+        return sorted(scores, key=lambda app_id: (-scores[app_id], -int(app_id)))
+
+
+class ArchiveSearchIndex(SearchIndex):
+    """Индекс архивных заявок в SQLite-файле рядом с сегментами архива.
+
+    Архивные заявки не меняются, поэтому их токены не держатся в памяти процесса:
+    словарь, триграммы и вхождения читаются из базы при каждом поиске.
+    """
+
+    def __init__(self, path: str, field_weights: Dict[str, int]):
+        super().__init__(field_weights)
+        # Журнал отката по умолчанию, а не WAL: WAL не работает на сетевых ФС, где лежит общий архив
+        self.conn = sqlite3.connect(path, timeout=30)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS postings (token TEXT NOT NULL, application_id TEXT NOT NULL, '
+                              'weight INTEGER NOT NULL, PRIMARY KEY (token, application_id)) WITHOUT ROWID')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS postings_application ON postings (application_id)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS trigrams (trigram TEXT NOT NULL, token TEXT NOT NULL, '
+                              'PRIMARY KEY (trigram, token)) WITHOUT ROWID')
+
+    def add(self, app: ApplicationRecord) -> None:
+        self.add_many([app])
+
+    def add_many(self, apps: Iterable[ApplicationRecord]) -> None:
+        """Индексирует заявки одной транзакцией"""
+        with self.conn:
+            for app in apps:
+                tokens = self.document_tokens(app)
+                self.conn.execute('DELETE FROM postings WHERE application_id = ?', (app.id,))
+                self.conn.executemany('INSERT INTO postings (token, application_id, weight) VALUES (?, ?, ?)',
+                                      [(token, app.id, weight) for token, weight in tokens.items()])
+                self.conn.executemany('INSERT OR IGNORE INTO trigrams (trigram, token) VALUES (?, ?)',
+                                      [(trigram, token) for token in tokens for trigram in self.token_trigrams(token)])
+
+    def remove(self, app_id: str) -> None:
+        # Триграммы токенов без вхождений не мешают поиску: такие токены не дают результатов
+        with self.conn:
+            self.conn.execute('DELETE FROM postings WHERE application_id = ?', (app_id,))
+
+    def indexed_ids(self) -> set:
+        return {row[0] for row in self.conn.execute('SELECT DISTINCT application_id FROM postings')}
+
+    def has_token(self, token: str) -> bool:
+        return self.conn.execute('SELECT 1 FROM postings WHERE token = ? LIMIT 1', (token,)).fetchone() is not None
+
+    def trigram_candidates(self, trigrams: set) -> set:
+        placeholders = ', '.join('?' * len(trigrams))
+        rows = self.conn.execute(f'SELECT token FROM trigrams WHERE trigram IN ({placeholders}) '
+                                 f'GROUP BY token HAVING COUNT(*) = ?', (*trigrams, len(trigrams)))
+        return {row[0] for row in rows}
+
+    def token_postings(self, token: str) -> Dict[str, int]:
+        return dict(self.conn.execute('SELECT application_id, weight FROM postings WHERE token = ?', (token,)))
+
+    def close(self) -> None:
+        self.conn.close()
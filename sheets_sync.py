@@ -0,0 +1,196 @@
+"""Двусторонняя синхронизация заявок с листом Google Sheets"""
+import re
+from typing import Callable, Dict, List
+
+import gspread
+from gspread.utils import rowcol_to_a1
+
+from state import ApplicationRecord, StateBackend, format_ts
+
+# Колонки листа синхронизации: (заголовок, поле заявки или функция от заявки)
+SHEET_COLUMNS = [
+    ('ID', 'id'),
+    ('Создана', lambda app: app.created_time),
+    ('Принята', lambda app: format_ts(app.accepted_at)),
+    ('Серийный номер', 'serial'),
+    ('Госномер', 'bus'),
+    ('Автопарк', 'garage'),
+    ('Телефон водителя', 'phone'),
+    ('Проблема', 'problem'),
+    ('Статус', lambda app: app.status.label),
+    ('Решение', 'solution'),
+    ('Решена', lambda app: app.resolved_time),
+    ('Диспетчер', 'dispatcher_name'),
+    ('Техник', 'technician_name'),
+    ('Фото', lambda app: app.photo or app.photo_file_id),
+]
+# Колонки, правки которых в таблице переносятся обратно в заявку
+SHEET_EDITABLE_FIELDS = {'serial', 'bus', 'garage', 'phone', 'problem', 'solution'}
+
+
+class SheetsSync:
+    """Двусторонняя синхронизация заявок с листом worksheet_name.
+
+    Последнее выгруженное содержимое строк хранится в общем хранилище (backend.sheet_rows),
+    поэтому при выгрузке отправляются только изменившиеся ячейки одним batch_update,
+    а правки из таблицы не теряются при сбоях и смене лидера. Лист перечитывается
+    только при смене ревизии документа — перед каждой выгрузкой, чтобы после
+    сортировки или удаления строк запись не попала в чужую строку.
+    """
+
+    def __init__(self, spreadsheet_factory: Callable, backend: StateBackend, worksheet_name: str):
+        self.spreadsheet_factory = spreadsheet_factory  # открывает документ (gspread.Spreadsheet)
+        self.backend = backend
+        self.worksheet_name = worksheet_name
+        self.reset()
+
+    def reset(self) -> None:
+        """Сбрасывает локальное состояние; при следующем обращении лист сверяется заново.
+        Выгруженные строки остаются в хранилище, так что правки, сделанные в таблице до сбоя, не теряются"""
+        self.spreadsheet = None
+        self.worksheet = None
+        self.row_index: Dict[str, int] = {}  # {application_id: номер строки}
+        self.synced_rows: Dict[str, List[str]] = {}  # копия backend.sheet_rows
+        self.edited: Dict[str, ApplicationRecord] = {}  # заявки, измененные правками из таблицы, для pull()
+        self.revision = None
+
+    @staticmethod
+    def render_row(app: ApplicationRecord) -> List[str]:
+        row = []
+        for _, source in SHEET_COLUMNS:
+            value = source(app) if callable(source) else getattr(app, source)
+            row.append('' if value is None else str(value))
+        return row
+
+    def ensure_loaded(self) -> None:
+        if self.worksheet is not None:
+            return
+        self.spreadsheet = self.spreadsheet_factory()
+        try:
+            self.worksheet = self.spreadsheet.worksheet(self.worksheet_name)
+        except gspread.WorksheetNotFound:
+            self.worksheet = self.spreadsheet.add_worksheet(self.worksheet_name, rows=1000, cols=len(SHEET_COLUMNS))
+        self.synced_rows = dict(self.backend.sheet_rows.items())
+
+    def remember(self, app_id: str, row: List[str]) -> None:
+        self.synced_rows[app_id] = row
+        self.backend.sheet_rows[app_id] = row
+
+    def refresh(self) -> None:
+        """Если ревизия документа изменилась, перечитывает лист: обновляет номера строк
+        и переносит в заявки правки, сделанные в таблице после последней выгрузки"""
+        self.ensure_loaded()
+        revision = self.spreadsheet.get_lastUpdateTime()
+        if revision == self.revision:
+            return
+        values = self.worksheet.get_all_values()
+        width = len(SHEET_COLUMNS)
+        if not values or values[0][:1] != ['ID']:
+            self.worksheet.update('A1', [[header for header, _ in SHEET_COLUMNS]])
+            values = [[]] + values[1:]
+        row_index = {}
+        for row_number, row in enumerate(values[1:], start=2):
+            if not row or not row[0]:
+                continue
+            app_id = row[0]
+            row = (row + [''] * width)[:width]
+            row_index[app_id] = row_number
+            old = self.synced_rows.get(app_id)
+            if old == row:
+                continue
+            if old is None or app_id not in self.backend.applications:
+                # Строку бот еще не выгружал или заявка уже в архиве — принимаем лист как есть
+                self.remember(app_id, row)
+                continue
+            self.apply_edits(app_id, old, row)
+        # Строки, удаленные из листа, выгрузятся заново при следующем изменении заявки
+        for app_id in set(self.synced_rows) - set(row_index):
+            del self.synced_rows[app_id]
+            self.backend.sheet_rows.pop(app_id, None)
+        self.row_index = row_index
+        self.revision = revision
+
+    def apply_edits(self, app_id: str, old: List[str], row: List[str]) -> None:
+        edits = {}
+        for i, (_, source) in enumerate(SHEET_COLUMNS):
+            if source in SHEET_EDITABLE_FIELDS and row[i] != old[i]:
+                # Пустая ячейка решения означает, что решения нет
+                edits[source] = (row[i] or None) if source == 'solution' else row[i]
+        rejected = []
+
+        # Меняются только отредактированные поля — статус и прочее, измененное ботом, сохраняются
+        def apply(app):
+            rejected.clear()
+            changed = False
+            for source, value in edits.items():
+                # По решению открытой заявки бот определяет шаг техника (ввод решения или фото)
+                if source == 'solution' and not app.status.is_closed:
+                    rejected.append(source)
+                    continue
+                setattr(app, source, value)
+                changed = True
+            return changed
+
+        app = self.backend.update_application(app_id, apply) if edits else None
+        if app is not None:
+            self.edited[app_id] = app
+        if rejected:
+            # Строка запоминается как в таблице, поэтому выгрузка вернет в ячейку значение бота
+            self.backend.push_queue('sheets', app_id)
+        self.remember(app_id, row)
+
+    def push(self, apps: List[ApplicationRecord]) -> int:
+        """Выгружает заявки: новые — одним append_rows, изменения — одним batch_update. Возвращает число запросов"""
+        self.refresh()
+        new_rows, new_ids, updates = [], [], []
+        for app in apps:
+            if app.id in self.edited:
+                # Правка из таблицы, перенесенная при сверке, новее переданной копии заявки
+                app = self.backend.applications.get(app.id, app)
+            row = self.render_row(app)
+            if app.id not in self.row_index:
+                new_rows.append(row)
+                new_ids.append(app.id)
+                continue
+            old = self.synced_rows.get(app.id)
+            changed = [i for i, value in enumerate(row) if old is None or old[i] != value]
+            if not changed:
+                continue
+            row_number = self.row_index[app.id]
+            # Соседние измененные ячейки объединяются в один диапазон
+            start = prev = None
+            for i in changed + [None]:
+                if start is not None and (i is None or i != prev + 1):
+                    updates.append({
+                        'range': f"{rowcol_to_a1(row_number, start + 1)}:{rowcol_to_a1(row_number, prev + 1)}",
+                        'values': [row[start:prev + 1]],
+                    })
+                    start = None
+                if i is not None and start is None:
+                    start = i
+                prev = i
+            self.remember(app.id, row)
+
+        requests = 0
+        if updates:
+            self.worksheet.batch_update(updates, value_input_option='RAW')
+            requests += 1
+        if new_rows:
+            response = self.worksheet.append_rows(new_rows, value_input_option='RAW', table_range='A1')
+            requests += 1
+            first_row = int(re.search(r'![A-Z]+(\d+)', response['updates']['updatedRange']).group(1))
+            for offset, (app_id, row) in enumerate(zip(new_ids, new_rows)):
+                self.row_index[app_id] = first_row + offset
+                self.remember(app_id, row)
+        if requests:
+            # Своя запись меняет ревизию; правка, попавшая между записью и этим чтением,
+            # перенесется при следующей смене ревизии, если бот не перезапишет ячейку раньше
+            self.revision = self.spreadsheet.get_lastUpdateTime()
+        return requests
+
+    def pull(self) -> List[ApplicationRecord]:
+        """Забирает правки из таблицы, если ревизия документа изменилась. Возвращает измененные заявки"""
+        self.refresh()
+        changed = list(self.edited.values())
+        self.edited = {}
+        return changed
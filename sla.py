@@ -0,0 +1,165 @@
+"""Сроки SLA по заявкам: иерархическое колесо таймеров и трекер эскалаций"""
+import json
+import logging
+import os
+import time
+from collections.abc import Mapping
+from typing import Dict, List, Optional
+
+from state import AppStatus, ApplicationRecord
+
+logger = logging.getLogger(__name__)
+
+
+class TimingWheel:
+    """Иерархическое колесо таймеров: вставка и отмена за O(1), продвижение — скачками между непустыми ячейками.
+
+    Уровень L содержит slots ячеек по slots**L тиков; таймер кладется на самый нижний уровень,
+    который покрывает его задержку, и опускается ниже, когда стрелка доходит до его ячейки.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 4, now: Optional[float] = None):
+        self.tick, self.slots, self.levels = tick, slots, levels
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.timers = {}  # {ключ: (уровень, ячейка)}
+        self.current = int((time.time() if now is None else now) // tick)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, key, deadline: float, payload=None) -> None:
+        """Ставит (или переставляет) таймер key на момент deadline"""
+        self.cancel(key)
+        # Просроченные таймеры срабатывают на ближайшем тике
+        self._place(key, max(int(-(-deadline // self.tick)), self.current + 1), payload)
+
+    def cancel(self, key) -> bool:
+        position = self.timers.pop(key, None)
+        if position is None:
+            return False
+        level, slot = position
+        del self.wheels[level][slot][key]
+        return True
+
+    def _place(self, key, deadline_tick: int, payload) -> None:
+        delta = deadline_tick - self.current
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1) or level == self.levels - 1:
+                break
+        # Таймеры дальше горизонта последнего уровня перекладываются при каждом обороте
+        slot = (deadline_tick // self.slots ** level) % self.slots
+        self.wheels[level][slot][key] = (deadline_tick, payload)
+        self.timers[key] = (level, slot)
+
+    def advance(self, now: Optional[float] = None) -> list:
+        """Продвигает стрелку до now и возвращает [(ключ, payload)] сработавших таймеров"""
+        target = int((time.time() if now is None else now) // self.tick)
+        fired = []
+        while self.current < target and self.timers:
+            # Тики без срабатываний и без непустых ячеек на границах уровней пропускаются
+            self.current = self._next_event(target)
+            # Сверху вниз, чтобы опущенные таймеры попали в ячейки, которые еще будут разобраны
+            for level in range(self.levels - 1, 0, -1):
+                span = self.slots ** level
+                if self.current % span == 0:
+                    bucket = self.wheels[level][(self.current // span) % self.slots]
+                    entries = list(bucket.items())
+                    bucket.clear()
+                    for key, (deadline_tick, payload) in entries:
+                        del self.timers[key]
+                        self._place(key, max(deadline_tick, self.current), payload)
+            bucket = self.wheels[0][self.current % self.slots]
+            for key, (deadline_tick, payload) in list(bucket.items()):
+                if deadline_tick <= self.current:
+                    del bucket[key]
+                    del self.timers[key]
+                    fired.append((key, payload))
+        # Пустое колесо догоняет время сразу
+        self.current = max(self.current, target)
+        return fired
+
+    def _next_event(self, target: int) -> int:
+        """Ближайший тик не позже target, на котором есть что срабатывать или опускать"""
+        nearest = target
+        for level in range(self.levels):
+            span = self.slots ** level
+            boundary = (self.current // span + 1) * span
+            # Обход одного оборота уровня: дальше ячейки повторяются
+            for _ in range(self.slots):
+                if boundary >= nearest:
+                    break
+                if self.wheels[level][(boundary // span) % self.slots]:
+                    nearest = boundary
+                    break
+                boundary += span
+        return nearest
+
+
+class SLATracker:
+    """Сроки принятия и решения заявок с лестницей эскалации техник → диспетчер → админ.
+
+    Ступень k для фазы срабатывает через threshold * (k + 1) от начала фазы; номер
+    следующей ступени хранится в заявке (sla_level), поэтому новый лидер продолжает
+    эскалацию с того же места.
+    """
+
+    def __init__(self, applications: Mapping, default_thresholds: Dict[str, int], levels: int):
+        self.applications = applications  # {application_id: ApplicationRecord} общего хранилища
+        self.levels = levels  # число ступеней эскалации
+        self.wheel = None
+        self.thresholds = {'default': dict(default_thresholds), 'garages': {}}
+
+    def load_config(self, path: str) -> None:
+        """Читает пороги из JSON: {"default": {"accept": 300, "resolve": 14400}, "garages": {"Парк 1": {...}}}"""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding='utf-8') as f:
+                config = json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка чтения настроек SLA: {e}")
+            return
+        self.thresholds['default'].update(config.get('default', {}))
+        self.thresholds['garages'] = config.get('garages', {})
+
+    def threshold(self, garage: str, phase: str) -> int:
+        return self.thresholds['garages'].get(garage, {}).get(phase, self.thresholds['default'][phase])
+
+    def reset(self) -> None:
+        self.wheel = None
+
+    def ensure_loaded(self) -> None:
+        if self.wheel is not None:
+            return
+        self.wheel = TimingWheel()
+        for app in self.applications.values():
+            self.refresh(app)
+
+    @staticmethod
+    def phase(app: ApplicationRecord):
+        """Текущая фаза заявки и момент ее начала"""
+        if app.status is AppStatus.ACTIVE:
+            return 'accept', app.created_at
+        if app.status is AppStatus.IN_PROGRESS:
+            return 'resolve', app.accepted_at
+        return None, None
+
+    def refresh(self, app: ApplicationRecord) -> None:
+        """Перепланирует таймер заявки по ее текущему статусу"""
+        self.wheel.cancel(app.id)
+        phase, started_at = self.phase(app)
+        if phase is None or app.sla_level >= self.levels:
+            return
+        deadline = started_at + self.threshold(app.garage, phase) * (app.sla_level + 1)
+        self.wheel.schedule(app.id, deadline, (phase, app.sla_level))
+
+    def due(self, now: Optional[float] = None) -> List[tuple]:
+        """Возвращает [(заявка, фаза, ступень)] наступивших сроков"""
+        result = []
+        for app_id, (phase, level) in self.wheel.advance(now):
+            app = self.applications.get(app_id)
+            # Заявку могли принять или закрыть на другом экземпляре
+            if app is None or self.phase(app)[0] != phase or app.sla_level != level:
+                continue
+            result.append((app, phase, level))
+        return result
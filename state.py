@@ -0,0 +1,831 @@
+"""Модель заявки и хранилища общего состояния бота (память процесса, SQLite, Redis)"""
+import json
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from collections.abc import MutableMapping
+from dataclasses import dataclass, asdict, fields, replace
+from datetime import datetime
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class AppStatus(str, Enum):
+    """Статусы заявки (члены перечисления — синглтоны, строки не дублируются)"""
+    ACTIVE = 'active'
+    IN_PROGRESS = 'in_progress'
+    RESOLVED = 'resolved'
+    UNRESOLVED = 'unresolved'
+
+    @property
+    def label(self) -> str:
+        return STATUS_LABELS[self]
+
+    @property
+    def is_closed(self) -> bool:
+        return self in (AppStatus.RESOLVED, AppStatus.UNRESOLVED)
+
+
+STATUS_LABELS = {
+    AppStatus.ACTIVE: 'Активная',
+    AppStatus.IN_PROGRESS: 'В работе',
+    AppStatus.RESOLVED: 'Решено',
+    AppStatus.UNRESOLVED: 'Не решено',
+}
+
+# Допустимые переходы между статусами
+STATUS_TRANSITIONS = {
+    AppStatus.ACTIVE: {AppStatus.IN_PROGRESS},
+    AppStatus.IN_PROGRESS: {AppStatus.RESOLVED, AppStatus.UNRESOLVED},
+    AppStatus.RESOLVED: set(),
+    AppStatus.UNRESOLVED: set(),
+}
+
+
+class InvalidTransition(Exception):
+    """Недопустимая смена статуса заявки"""
+
+
+def format_ts(ts: Optional[int]) -> str:
+    """Форматирует epoch-время для вывода пользователю"""
+    if ts is None:
+        return ''
+    return datetime.fromtimestamp(ts).strftime(TIME_FORMAT)
+
+
+@dataclass(slots=True)
+class ApplicationRecord:
+    """Заявка. Время хранится в секундах epoch и форматируется только при выводе"""
+    id: str
+    serial: str
+    problem: str
+    phone: str
+    bus: str
+    garage: str
+    dispatcher_id: int
+    dispatcher_name: str
+    created_at: int
+    status: AppStatus = AppStatus.ACTIVE
+    technician_id: Optional[int] = None
+    technician_name: Optional[str] = None
+    accepted_at: Optional[int] = None
+    outcome: Optional[AppStatus] = None  # выбранный техником итог до загрузки фото
+    solution: Optional[str] = None
+    photo: Optional[str] = None
+    photo_file_id: Optional[str] = None  # file_id в Telegram, остается доступен после удаления локального файла
+    resolved_at: Optional[int] = None
+    sla_level: int = 0  # сколько ступеней эскалации пройдено в текущей фазе
+
+    def __post_init__(self):
+        # Автопарки и имена сильно повторяются между заявками
+        self.garage = sys.intern(self.garage)
+        self.dispatcher_name = sys.intern(self.dispatcher_name)
+
+    def transition(self, new_status: AppStatus) -> None:
+        """Меняет статус, проверяя допустимость перехода"""
+        if new_status not in STATUS_TRANSITIONS[self.status]:
+            raise InvalidTransition(f"{self.status.value} -> {new_status.value}")
+        self.status = new_status
+
+    @property
+    def created_time(self) -> str:
+        return format_ts(self.created_at)
+
+    @property
+    def resolved_time(self) -> str:
+        return format_ts(self.resolved_at)
+
+
+RECORD_FIELDS = {f.name for f in fields(ApplicationRecord)}
+
+
+def record_to_dict(app: ApplicationRecord) -> dict:
+    """Сериализует заявку для записи в архив"""
+    data = asdict(app)
+    data['status'] = app.status.value
+    data['outcome'] = app.outcome.value if app.outcome else None
+    return data
+
+def record_from_dict(data: dict) -> ApplicationRecord:
+    """Восстанавливает заявку из архивной записи"""
+    # Поля, удаленные из ApplicationRecord, в старых записях пропускаются
+    data = {key: value for key, value in data.items() if key in RECORD_FIELDS}
+    data['status'] = AppStatus(data['status'])
+    data['outcome'] = AppStatus(data['outcome']) if data.get('outcome') else None
+    return ApplicationRecord(**data)
+
+
+class RedisError(Exception):
+    """Ошибка, возвращенная Redis-сервером"""
+
+
+class RedisClient:
+    """Минимальный клиент протокола Redis (RESP) без внешних зависимостей"""
+
+    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, timeout: float = 5):
+        self.host, self.port, self.db = host, port, db
+        self.password, self.timeout = password, timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.reader = None
+
+    def connect(self) -> None:
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.reader = self.sock.makefile('rb')
+        if self.password:
+            self._call('AUTH', self.password)
+        if self.db:
+            self._call('SELECT', self.db)
+
+    def close(self) -> None:
+        if self.sock:
+            self.sock.close()
+        self.sock = self.reader = None
+
+    def execute(self, *args):
+        with self.lock:
+            try:
+                self._send(args)
+            except OSError:
+                # Команда не ушла на сервер — повторить безопасно даже для INCR/RPUSH
+                self.close()
+                self._send(args)
+            try:
+                return self._read_reply()
+            except OSError:
+                # Сервер мог уже выполнить команду: повтор мог бы применить ее дважды
+                self.close()
+                raise
+
+    def transaction(self, keys, build):
+        """Оптимистичная транзакция WATCH/MULTI/EXEC.
+
+        build(call) читает данные через call и возвращает список команд для MULTI.
+        Без keys команды просто выполняются вместе, без проверки конфликтов.
+        Возвращает ответ EXEC или None, если наблюдаемые ключи успели изменить.
+        """
+        with self.lock:
+            try:
+                if keys:
+                    self._call('WATCH', *keys)
+                commands = build(self._call)
+                if not commands:
+                    if keys:
+                        self._call('UNWATCH')
+                    return []
+                self._call('MULTI')
+                for command in commands:
+                    self._call(*command)
+                return self._call('EXEC')
+            except OSError:
+                # Состояние транзакции на сервере неизвестно — начинаем с нового соединения
+                self.close()
+                raise
+
+    def _send(self, args) -> None:
+        if self.sock is None:
+            self.connect()
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self.sock.sendall(b''.join(parts))
+
+    def _call(self, *args):
+        self._send(args)
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Соединение с Redis закрыто")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode()
+        if prefix == b'-':
+            raise RedisError(payload.decode())
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            return self.reader.read(length + 2)[:-2].decode()
+        if prefix == b'*':
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RedisError(f"Неизвестный ответ Redis: {line!r}")
+
+
+def encode_record(app: ApplicationRecord) -> str:
+    return json.dumps(record_to_dict(app), ensure_ascii=False)
+
+def decode_record(value: str) -> ApplicationRecord:
+    return record_from_dict(json.loads(value))
+
+
+class SQLiteConnection:
+    """Соединение SQLite, общее для потоков: запросы и транзакции идут под одной блокировкой,
+    иначе одиночный запрос другого потока попал бы внутрь чужой транзакции"""
+
+    def __init__(self, path: str):
+        self.raw = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+
+    def execute(self, sql: str, params=()):
+        with self.lock:
+            return self.raw.execute(sql, params)
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE: блокировка на запись берется сразу, до чтения"""
+        with self.lock:
+            self.raw.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.raw.execute('ROLLBACK')
+                raise
+            self.raw.execute('COMMIT')
+
+
+class SQLiteMapping(MutableMapping):
+    """Словарь поверх таблицы SQLite (key TEXT PRIMARY KEY, value TEXT)"""
+
+    def __init__(self, conn: SQLiteConnection, table: str, decode_key=str, encode=str, decode=str):
+        self.conn, self.table = conn, table
+        self.decode_key, self.encode, self.decode = decode_key, encode, decode
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def __getitem__(self, key):
+        row = self.conn.execute(f'SELECT value FROM {self.table} WHERE key = ?', (str(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self.decode(row[0])
+
+    def __setitem__(self, key, value):
+        self.conn.execute(f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)',
+                          (str(key), self.encode(value)))
+
+    def __delitem__(self, key):
+        cursor = self.conn.execute(f'DELETE FROM {self.table} WHERE key = ?', (str(key),))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.conn.execute(f'SELECT 1 FROM {self.table} WHERE key = ?', (str(key),)).fetchone() is not None
+
+    def __iter__(self):
+        return (self.decode_key(row[0]) for row in self.conn.execute(f'SELECT key FROM {self.table}').fetchall())
+
+    def __len__(self):
+        return self.conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    # items()/values() одним запросом вместо запроса на каждый ключ
+    def items(self):
+        rows = self.conn.execute(f'SELECT key, value FROM {self.table}').fetchall()
+        return [(self.decode_key(key), self.decode(value)) for key, value in rows]
+
+    def values(self):
+        rows = self.conn.execute(f'SELECT value FROM {self.table}').fetchall()
+        return [self.decode(row[0]) for row in rows]
+
+
+class RedisMapping(MutableMapping):
+    """Словарь поверх хеша Redis"""
+
+    def __init__(self, client: RedisClient, name: str, decode_key=str, encode=str, decode=str):
+        self.client, self.name = client, name
+        self.decode_key, self.encode, self.decode = decode_key, encode, decode
+
+    def __getitem__(self, key):
+        value = self.client.execute('HGET', self.name, key)
+        if value is None:
+            raise KeyError(key)
+        return self.decode(value)
+
+    def __setitem__(self, key, value):
+        self.client.execute('HSET', self.name, key, self.encode(value))
+
+    def __delitem__(self, key):
+        if not self.client.execute('HDEL', self.name, key):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return bool(self.client.execute('HEXISTS', self.name, key))
+
+    def __iter__(self):
+        return (self.decode_key(key) for key in self.client.execute('HKEYS', self.name))
+
+    def __len__(self):
+        return self.client.execute('HLEN', self.name)
+
+    # items()/values() одной командой вместо HGET на каждый ключ
+    def items(self):
+        flat = self.client.execute('HGETALL', self.name)
+        return [(self.decode_key(flat[i]), self.decode(flat[i + 1])) for i in range(0, len(flat), 2)]
+
+    def values(self):
+        return [self.decode(value) for value in self.client.execute('HVALS', self.name)]
+
+
+class ConcurrentUpdate(Exception):
+    """Запись не удалось обновить из-за постоянных параллельных изменений"""
+
+
+# Сколько раз повторять оптимистичную транзакцию при конфликте
+UPDATE_RETRIES = 10
+# С какого размера хранилище в памяти вычищает истекшие аренды и полные корзины
+MEMORY_PRUNE_THRESHOLD = 10000
+
+
+def take_from_bucket(state: Optional[Tuple[float, float]], capacity: float, rate: float,
+                     now: float) -> Tuple[float, float, float]:
+    """Корзина токенов: capacity запросов подряд, далее rate запросов в секунду.
+
+    state — (токены, время обновления) или None для полной корзины. Возвращает
+    (токены после запроса, сколько ждать следующего токена или 0, когда корзина снова заполнится).
+    """
+    tokens = capacity if state is None else min(capacity, state[0] + (now - state[1]) * rate)
+    wait = 0.0
+    if tokens >= 1:
+        tokens -= 1
+    else:
+        wait = (1 - tokens) / rate
+    return tokens, wait, now + (capacity - tokens) / rate
+
+
+class StateBackend(ABC):
+    """Хранилище общего состояния бота.
+
+    Заявки, роли и текущие заявки техников доступны как словари,
+    атомарные операции (счетчик, изменение заявки, аренда лидера, очередь) — как методы.
+    Существующие заявки меняются только через update_application(): запись целиком
+    через applications[id] затерла бы изменения, сделанные другим экземпляром.
+    """
+
+    applications: MutableMapping   # {application_id: ApplicationRecord}
+    users_roles: MutableMapping    # {user_id: 'admin'/'dispatcher'/'technician'}
+    current_applications: MutableMapping  # {technician_id: application_id}
+    sheet_rows: MutableMapping  # {application_id: строка, последний раз выгруженная в Google Sheets}
+    log_readers: MutableMapping  # {'журнал:экземпляр': 'позиция чтения время'} — до какой позиции журнал можно удалять
+
+    @abstractmethod
+    def update_application(self, app_id: str,
+                           mutate: Callable[[ApplicationRecord], bool]) -> Optional[ApplicationRecord]:
+        """Атомарно читает заявку, применяет mutate и сохраняет результат.
+
+        mutate получает свежую копию заявки и возвращает False, если менять ее не нужно
+        (например, статус уже сменил другой экземпляр). Возвращает сохраненную заявку
+        или None, если заявки нет или mutate отказался от изменения.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def next_application_id(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def ensure_counter(self, value: int) -> None:
+        """Гарантирует, что следующие id будут больше value"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def incr_stats(self, increments: Dict[str, float]) -> None:
+        """Атомарно прибавляет значения к счетчикам статистики"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_stats(self) -> Dict[str, float]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Берет или продлевает аренду name на ttl секунд; True, если владелец — owner"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def put_expiring(self, key: str, value: str, ttl: float) -> None:
+        """Сохраняет значение на ttl секунд; повторная запись продлевает срок"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_expiring(self, key: str) -> Optional[str]:
+        """Значение, сохраненное put_expiring, или None, если срок истек"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def take_token(self, key: str, capacity: float, rate: float) -> float:
+        """Берет токен из корзины key; 0, если токен взят, иначе через сколько секунд появится следующий.
+        Полная корзина не хранится: ее запись истекает, как только токены восстановятся"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def push_queue(self, name: str, value: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def pop_queue(self, name: str, limit: int) -> List[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def append_log(self, name: str, value: str) -> None:
+        """Дописывает запись в журнал, который читают все экземпляры (в отличие от очереди)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_log(self, name: str, offset: int) -> Tuple[int, List[str]]:
+        """Возвращает новую позицию чтения и записи журнала после offset"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def log_end(self, name: str) -> int:
+        """Позиция после последней записи журнала — без чтения самих записей"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def trim_log(self, name: str, offset: int) -> None:
+        """Удаляет записи журнала до позиции offset включительно; позиции остальных записей не меняются"""
+        raise NotImplementedError
+
+
+class InMemoryBackend(StateBackend):
+    """Состояние в памяти процесса — для запуска в одном экземпляре"""
+
+    def __init__(self):
+        self.applications = {}
+        self.users_roles = {}
+        self.current_applications = {}
+        self.sheet_rows = {}
+        self.log_readers = {}
+        self.counter = 0
+        self.stats = {}
+        self.leases = {}
+        self.expiring = {}  # {ключ: (значение, срок)}
+        self.buckets = {}
+        self.queues = {}
+        self.logs = {}
+        self.log_bases = {}  # {журнал: позиция первой хранимой записи}
+
+    def update_application(self, app_id, mutate):
+        app = self.applications.get(app_id)
+        if app is None:
+            return None
+        # Копия, чтобы отказ mutate после частичных изменений не оставил их в заявке
+        app = replace(app)
+        if not mutate(app):
+            return None
+        self.applications[app_id] = app
+        return app
+
+    def next_application_id(self) -> int:
+        self.counter += 1
+        return self.counter
+
+    def ensure_counter(self, value: int) -> None:
+        self.counter = max(self.counter, value)
+
+    def incr_stats(self, increments):
+        for name, amount in increments.items():
+            self.stats[name] = self.stats.get(name, 0) + amount
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        holder, expires = self.leases.get(name, (None, 0))
+        if holder in (None, owner) or expires <= now:
+            self.leases[name] = (owner, now + ttl)
+            if len(self.leases) > MEMORY_PRUNE_THRESHOLD:
+                self.leases = {key: lease for key, lease in self.leases.items() if lease[1] > now}
+            return True
+        return False
+
+    def put_expiring(self, key: str, value: str, ttl: float) -> None:
+        now = time.time()
+        self.expiring[key] = (value, now + ttl)
+        if len(self.expiring) > MEMORY_PRUNE_THRESHOLD:
+            self.expiring = {name: item for name, item in self.expiring.items() if item[1] > now}
+
+    def get_expiring(self, key: str) -> Optional[str]:
+        value, expires = self.expiring.get(key, (None, 0))
+        return value if expires > time.time() else None
+
+    def take_token(self, key: str, capacity: float, rate: float) -> float:
+        now = time.time()
+        state = self.buckets.get(key)
+        if state is not None and state[2] <= now:
+            state = None
+        tokens, wait, full_at = take_from_bucket(state, capacity, rate, now)
+        self.buckets[key] = (tokens, now, full_at)
+        if len(self.buckets) > MEMORY_PRUNE_THRESHOLD:
+            self.buckets = {name: bucket for name, bucket in self.buckets.items() if bucket[2] > now}
+        return wait
+
+    def push_queue(self, name: str, value: str) -> None:
+        self.queues.setdefault(name, []).append(value)
+
+    def pop_queue(self, name: str, limit: int) -> List[str]:
+        queue = self.queues.get(name, [])
+        items, self.queues[name] = queue[:limit], queue[limit:]
+        return items
+
+    def append_log(self, name, value):
+        self.logs.setdefault(name, []).append(value)
+
+    def read_log(self, name, offset):
+        log, base = self.logs.get(name, []), self.log_bases.get(name, 0)
+        return base + len(log), log[max(0, offset - base):]
+
+    def log_end(self, name):
+        return self.log_bases.get(name, 0) + len(self.logs.get(name, []))
+
+    def trim_log(self, name, offset):
+        base = self.log_bases.get(name, 0)
+        if offset > base:
+            del self.logs.get(name, [])[:offset - base]
+            self.log_bases[name] = offset
+
+
+class SQLiteBackend(StateBackend):
+    """Состояние в файле SQLite — для нескольких процессов на одной машине"""
+
+    def __init__(self, path: str):
+        self.conn = SQLiteConnection(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS leases_expires ON leases (expires)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS expiring (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS expiring_expires ON expiring (expires)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS buckets '
+                          '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS buckets_full_at ON buckets (full_at)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS queue (seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, value TEXT NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS log (seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, value TEXT NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS log_name ON log (name, seq)')
+        self.applications = SQLiteMapping(self.conn, 'applications', encode=encode_record, decode=decode_record)
+        self.users_roles = SQLiteMapping(self.conn, 'roles', decode_key=int)
+        self.current_applications = SQLiteMapping(self.conn, 'current_applications', decode_key=int)
+        self.sheet_rows = SQLiteMapping(self.conn, 'sheet_rows', encode=json.dumps, decode=json.loads)
+        self.log_readers = SQLiteMapping(self.conn, 'log_readers')
+
+    def update_application(self, app_id, mutate):
+        with self.conn.transaction():
+            app = self.applications.get(app_id)
+            if app is None or not mutate(app):
+                return None
+            self.applications[app_id] = app
+            return app
+
+    def next_application_id(self) -> int:
+        with self.conn.transaction():
+            self.conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('applications', 0)")
+            self.conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'applications'")
+            return self.conn.execute("SELECT value FROM counters WHERE name = 'applications'").fetchone()[0]
+
+    def ensure_counter(self, value: int) -> None:
+        with self.conn.transaction():
+            self.conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('applications', 0)")
+            self.conn.execute("UPDATE counters SET value = MAX(value, ?) WHERE name = 'applications'", (value,))
+
+    def incr_stats(self, increments):
+        with self.conn.transaction():
+            for name, amount in increments.items():
+                self.conn.execute('INSERT INTO stats (name, value) VALUES (?, ?) '
+                                  'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value', (name, amount))
+
+    def get_stats(self):
+        return dict(self.conn.execute('SELECT name, value FROM stats').fetchall())
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self.conn.transaction():
+            # Истекшие аренды (в том числе короткие для отсева повторов) удаляются по индексу
+            self.conn.execute('DELETE FROM leases WHERE expires <= ?', (now,))
+            row = self.conn.execute('SELECT owner, expires FROM leases WHERE name = ?', (name,)).fetchone()
+            if row is None or row[0] == owner or row[1] <= now:
+                self.conn.execute('INSERT OR REPLACE INTO leases (name, owner, expires) VALUES (?, ?, ?)',
+                                  (name, owner, now + ttl))
+                return True
+            return False
+
+    def put_expiring(self, key: str, value: str, ttl: float) -> None:
+        now = time.time()
+        with self.conn.transaction():
+            self.conn.execute('DELETE FROM expiring WHERE expires <= ?', (now,))
+            self.conn.execute('INSERT OR REPLACE INTO expiring (key, value, expires) VALUES (?, ?, ?)',
+                              (key, value, now + ttl))
+
+    def get_expiring(self, key: str) -> Optional[str]:
+        row = self.conn.execute('SELECT value FROM expiring WHERE key = ? AND expires > ?',
+                                (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def take_token(self, key: str, capacity: float, rate: float) -> float:
+        now = time.time()
+        with self.conn.transaction():
+            self.conn.execute('DELETE FROM buckets WHERE full_at <= ?', (now,))
+            state = self.conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, wait, full_at = take_from_bucket(state, capacity, rate, now)
+            self.conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)',
+                              (key, tokens, now, full_at))
+        return wait
+
+    def push_queue(self, name: str, value: str) -> None:
+        self.conn.execute('INSERT INTO queue (name, value) VALUES (?, ?)', (name, value))
+
+    def pop_queue(self, name: str, limit: int) -> List[str]:
+        with self.conn.transaction():
+            rows = self.conn.execute('SELECT seq, value FROM queue WHERE name = ? ORDER BY seq LIMIT ?',
+                                     (name, limit)).fetchall()
+            if rows:
+                self.conn.execute('DELETE FROM queue WHERE name = ? AND seq <= ?', (name, rows[-1][0]))
+        return [value for _, value in rows]
+
+    def append_log(self, name, value):
+        self.conn.execute('INSERT INTO log (name, value) VALUES (?, ?)', (name, value))
+
+    def read_log(self, name, offset):
+        # Позиция — seq последней прочитанной записи; seq общий для всех журналов, поэтому идет с пропусками
+        rows = self.conn.execute('SELECT seq, value FROM log WHERE name = ? AND seq > ? ORDER BY seq',
+                                 (name, offset)).fetchall()
+        return (rows[-1][0] if rows else offset), [value for _, value in rows]
+
+    def log_end(self, name):
+        # Последний выданный seq: после удаления записей MAX(seq) по журналу мог бы уменьшиться
+        row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'log'").fetchone()
+        return row[0] if row else 0
+
+    def trim_log(self, name, offset):
+        self.conn.execute('DELETE FROM log WHERE name = ? AND seq <= ?', (name, offset))
+
+
+class RedisBackend(StateBackend):
+    """Состояние в Redis — для нескольких экземпляров на разных машинах"""
+
+    def __init__(self, client: RedisClient, prefix: str = 'telegtambot'):
+        self.client, self.prefix = client, prefix
+        self.applications = RedisMapping(client, self.key('applications'), encode=encode_record, decode=decode_record)
+        self.users_roles = RedisMapping(client, self.key('roles'), decode_key=int)
+        self.current_applications = RedisMapping(client, self.key('current_applications'), decode_key=int)
+        self.sheet_rows = RedisMapping(client, self.key('sheet_rows'), encode=json.dumps, decode=json.loads)
+        self.log_readers = RedisMapping(client, self.key('log_readers'))
+
+    def key(self, name: str) -> str:
+        return f'{self.prefix}:{name}'
+
+    def update_application(self, app_id, mutate):
+        key = self.applications.name
+        for _ in range(UPDATE_RETRIES):
+            updated = []
+
+            def build(call):
+                value = call('HGET', key, app_id)
+                if value is None:
+                    return []
+                app = decode_record(value)
+                if not mutate(app):
+                    return []
+                updated.append(app)
+                return [('HSET', key, app_id, encode_record(app))]
+
+            if self.client.transaction([key], build) is not None:
+                return updated[0] if updated else None
+        raise ConcurrentUpdate(app_id)
+
+    def next_application_id(self) -> int:
+        return self.client.execute('INCR', self.key('counter'))
+
+    def ensure_counter(self, value: int) -> None:
+        key = self.key('counter')
+
+        def build(call):
+            current = int(call('GET', key) or 0)
+            return [('SET', key, value)] if current < value else []
+
+        # Если счетчик изменил другой экземпляр между GET и EXEC, сравнение повторяется
+        for _ in range(UPDATE_RETRIES):
+            if self.client.transaction([key], build) is not None:
+                return
+        raise ConcurrentUpdate(key)
+
+    def incr_stats(self, increments):
+        key = self.key('stats')
+        self.client.transaction([], lambda call: [('HINCRBYFLOAT', key, name, amount)
+                                                  for name, amount in increments.items()])
+
+    def get_stats(self):
+        flat = self.client.execute('HGETALL', self.key('stats'))
+        return {flat[i]: float(flat[i + 1]) for i in range(0, len(flat), 2)}
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        key = self.key(f'lease:{name}')
+        if self.client.execute('SET', key, owner, 'NX', 'PX', int(ttl * 1000)) == 'OK':
+            return True
+        if self.client.execute('GET', key) == owner:
+            # Продление без Lua: в худшем случае аренда истечет и будет перехвачена на следующем цикле
+            self.client.execute('PEXPIRE', key, int(ttl * 1000))
+            return True
+        return False
+
+    def put_expiring(self, key: str, value: str, ttl: float) -> None:
+        self.client.execute('SET', self.key(f'expiring:{key}'), value, 'PX', int(ttl * 1000))
+
+    def get_expiring(self, key: str) -> Optional[str]:
+        return self.client.execute('GET', self.key(f'expiring:{key}'))
+
+    def take_token(self, key: str, capacity: float, rate: float) -> float:
+        key = self.key(f'bucket:{key}')
+        for _ in range(UPDATE_RETRIES):
+            result = []
+
+            def build(call):
+                now = time.time()
+                value = call('GET', key)
+                state = tuple(map(float, value.split())) if value else None
+                tokens, wait, full_at = take_from_bucket(state, capacity, rate, now)
+                result.append(wait)
+                # Ключ живет, пока корзина не заполнится: отсутствие ключа и есть полная корзина
+                return [('SET', key, f'{tokens} {now}', 'PX', max(1, int((full_at - now) * 1000)))]
+
+            if self.client.transaction([key], build) is not None:
+                return result[0]
+        raise ConcurrentUpdate(key)
+
+    def push_queue(self, name: str, value: str) -> None:
+        self.client.execute('RPUSH', self.key(f'queue:{name}'), value)
+
+    def pop_queue(self, name: str, limit: int) -> List[str]:
+        items = []
+        for _ in range(limit):
+            value = self.client.execute('LPOP', self.key(f'queue:{name}'))
+            if value is None:
+                break
+            items.append(value)
+        return items
+
+    def append_log(self, name, value):
+        self.client.execute('RPUSH', self.key(f'log:{name}'), value)
+
+    # Журнал — список log:<name> и позиция его первого элемента log:<name>:base,
+    # которая растет при удалении прочитанных записей
+    def read_log(self, name, offset):
+        key, base_key = self.key(f'log:{name}'), self.key(f'log:{name}:base')
+        for _ in range(UPDATE_RETRIES):
+            bases = []
+
+            def build(call):
+                bases.append(int(call('GET', base_key) or 0))
+                return [('LRANGE', key, max(0, offset - bases[-1]), -1)]
+
+            reply = self.client.transaction([base_key], build)
+            if reply is not None:
+                items = reply[0]
+                return max(offset, bases[-1]) + len(items), items
+        raise ConcurrentUpdate(key)
+
+    def log_end(self, name):
+        base, length = self.client.transaction([], lambda call: [('GET', self.key(f'log:{name}:base')),
+                                                                 ('LLEN', self.key(f'log:{name}'))])
+        return int(base or 0) + length
+
+    def trim_log(self, name, offset):
+        key, base_key = self.key(f'log:{name}'), self.key(f'log:{name}:base')
+
+        def build(call):
+            drop = offset - int(call('GET', base_key) or 0)
+            if drop <= 0:
+                return []
+            return [('LTRIM', key, drop, -1), ('INCRBY', base_key, drop)]
+
+        for _ in range(UPDATE_RETRIES):
+            if self.client.transaction([base_key], build) is not None:
+                return
+        raise ConcurrentUpdate(key)
+
+
+def create_backend(url: str) -> StateBackend:
+    """Создает хранилище по STATE_BACKEND: memory, sqlite:///path/to/file.db или redis://[:password@]host:port/db"""
+    parsed = urlparse(url)
+    if parsed.scheme in ('', 'memory'):
+        return InMemoryBackend()
+    if parsed.scheme == 'sqlite':
+        # sqlite:///state.db — относительный путь, sqlite:////var/lib/bot/state.db — абсолютный
+        return SQLiteBackend(parsed.path[1:] or 'state.db')
+    if parsed.scheme == 'redis':
+        db = int(parsed.path.lstrip('/') or 0)
+        return RedisBackend(RedisClient(parsed.hostname or 'localhost', parsed.port or 6379, db, parsed.password))
+    raise ValueError(f"Неизвестный STATE_BACKEND: {url}")
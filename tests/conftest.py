@@ -0,0 +1,53 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_redis import FakeRedisServer  # noqa: E402
+from state import ApplicationRecord, create_backend  # noqa: E402
+
+
+@pytest.fixture
+def redis_server():
+    server = FakeRedisServer()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def backends(request, tmp_path):
+    """Два экземпляра хранилища над общим состоянием, как у двух запущенных ботов"""
+    if request.param == 'memory':
+        backend = create_backend('memory')
+        return backend, backend
+    if request.param == 'sqlite':
+        url = f'sqlite:///{tmp_path / "state.db"}'
+    else:
+        server = request.getfixturevalue('redis_server')
+        url = f'redis://127.0.0.1:{server.port}/0'
+    return create_backend(url), create_backend(url)
+
+
+@pytest.fixture
+def bot(monkeypatch, tmp_path):
+    """Модуль bot со свежим состоянием в памяти; логи и архив пишутся во временный каталог"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('STATE_BACKEND', 'memory')
+    return importlib.reload(importlib.import_module('bot'))
+
+
+@pytest.fixture
+def make_record():
+    return build_record
+
+
+def build_record(app_id='1', **kwargs) -> ApplicationRecord:
+    data = dict(id=app_id, serial='SN-1', problem='Не работает валидатор', phone='+77001234567',
+                bus='123ABC01', garage='Автопарк №1', dispatcher_id=10, dispatcher_name='Диспетчер',
+                created_at=1_700_000_000)
+    data.update(kwargs)
+    return ApplicationRecord(**data)
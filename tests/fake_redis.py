@@ -0,0 +1,251 @@
+"""Упрощенный Redis-сервер в памяти для тестов RedisClient/RedisBackend.
+
+Поддерживает только команды, которые использует state.py, включая WATCH/MULTI/EXEC.
+"""
+import socketserver
+import threading
+import time
+
+
+class FakeRedisStore:
+    """Данные сервера: значения, сроки жизни и версии ключей для WATCH"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.data = {}
+        self.expires = {}
+        self.versions = {}
+        self.commands = []  # журнал выполненных команд для проверок в тестах
+
+    def touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def expire_stale(self, key):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+            self.touch(key)
+
+    def run(self, args):
+        """Выполняет команду и возвращает значение ответа (исключение — ошибка Redis)"""
+        command, args = args[0].upper(), args[1:]
+        self.commands.append(command)
+        if args:
+            self.expire_stale(args[0])
+        handler = getattr(self, 'cmd_' + command.lower(), None)
+        if handler is None:
+            raise ValueError(f"ERR unknown command '{command}'")
+        return handler(*args)
+
+    def hash(self, key):
+        return self.data.setdefault(key, {})
+
+    def cmd_ping(self):
+        return 'PONG'
+
+    def cmd_auth(self, password):
+        return 'OK'
+
+    def cmd_select(self, db):
+        return 'OK'
+
+    def cmd_get(self, key):
+        return self.data.get(key)
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        if 'NX' in options and key in self.data:
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if 'PX' in options:
+            self.expires[key] = time.time() + int(options[options.index('PX') + 1]) / 1000
+        self.touch(key)
+        return 'OK'
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            if self.data.pop(key, None) is not None:
+                removed += 1
+                self.touch(key)
+            self.expires.pop(key, None)
+        return removed
+
+    def cmd_pexpire(self, key, ms):
+        if key not in self.data:
+            return 0
+        self.expires[key] = time.time() + int(ms) / 1000
+        return 1
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, 1)
+
+    def cmd_incrby(self, key, amount):
+        value = int(self.data.get(key, 0)) + int(amount)
+        self.data[key] = str(value)
+        self.touch(key)
+        return value
+
+    def cmd_hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def cmd_hset(self, key, *pairs):
+        target = self.hash(key)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in target
+            target[field] = value
+        self.touch(key)
+        return added
+
+    def cmd_hsetnx(self, key, field, value):
+        target = self.hash(key)
+        if field in target:
+            return 0
+        target[field] = value
+        self.touch(key)
+        return 1
+
+    def cmd_hdel(self, key, *fields):
+        target = self.data.get(key, {})
+        removed = sum(target.pop(field, None) is not None for field in fields)
+        if removed:
+            self.touch(key)
+        return removed
+
+    def cmd_hexists(self, key, field):
+        return int(field in self.data.get(key, {}))
+
+    def cmd_hkeys(self, key):
+        return list(self.data.get(key, {}))
+
+    def cmd_hvals(self, key):
+        return list(self.data.get(key, {}).values())
+
+    def cmd_hlen(self, key):
+        return len(self.data.get(key, {}))
+
+    def cmd_hgetall(self, key):
+        return [item for pair in self.data.get(key, {}).items() for item in pair]
+
+    def cmd_hincrbyfloat(self, key, field, amount):
+        target = self.hash(key)
+        value = float(target.get(field, 0)) + float(amount)
+        target[field] = repr(value)
+        self.touch(key)
+        return target[field]
+
+    def cmd_rpush(self, key, *values):
+        target = self.data.setdefault(key, [])
+        target.extend(values)
+        self.touch(key)
+        return len(target)
+
+    def cmd_lpop(self, key):
+        target = self.data.get(key)
+        if not target:
+            return None
+        self.touch(key)
+        return target.pop(0)
+
+    def cmd_lrange(self, key, start, stop):
+        target = self.data.get(key, [])
+        stop = int(stop)
+        return target[int(start):None if stop == -1 else stop + 1]
+
+    def cmd_ltrim(self, key, start, stop):
+        stop = int(stop)
+        self.data[key] = self.data.get(key, [])[int(start):None if stop == -1 else stop + 1]
+        self.touch(key)
+        return 'OK'
+
+    def cmd_llen(self, key):
+        return len(self.data.get(key, []))
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Одно клиентское соединение: разбор RESP и состояние транзакции"""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2].decode())
+        return args
+
+    def encode(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, list):
+            return b'*%d\r\n' % len(value) + b''.join(self.encode(item) for item in value)
+        if isinstance(value, Exception):
+            return b'-%s\r\n' % str(value).encode()
+        if value in ('OK', 'QUEUED', 'PONG'):
+            return b'+%s\r\n' % value.encode()
+        data = value.encode()
+        return b'$%d\r\n%s\r\n' % (len(data), data)
+
+    def handle(self):
+        store = self.server.store
+        watched, queued = {}, None
+        while True:
+            try:
+                args = self.read_command()
+            except (OSError, ValueError):
+                return
+            if args is None:
+                return
+            command = args[0].upper()
+            with store.lock:
+                if command == 'WATCH':
+                    for key in args[1:]:
+                        store.expire_stale(key)
+                        watched[key] = store.versions.get(key, 0)
+                    reply = 'OK'
+                elif command == 'UNWATCH':
+                    watched, reply = {}, 'OK'
+                elif command == 'MULTI':
+                    queued, reply = [], 'OK'
+                elif command == 'EXEC':
+                    conflict = any(store.versions.get(key, 0) != version for key, version in watched.items())
+                    reply = None if conflict else [self.safe_run(store, item) for item in queued]
+                    watched, queued = {}, None
+                elif queued is not None:
+                    queued.append(args)
+                    reply = 'QUEUED'
+                else:
+                    reply = self.safe_run(store, args)
+            self.wfile.write(self.encode(reply))
+
+    @staticmethod
+    def safe_run(store, args):
+        try:
+            return store.run(args)
+        except Exception as e:
+            return e
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeRedisHandler)
+        self.store = FakeRedisStore()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,237 @@
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+
+from telegram.ext import ApplicationHandlerStop
+
+from sla import TimingWheel
+
+
+class FakeBot:
+    """Заменяет telegram.Bot: запоминает отправленные сообщения"""
+
+    def __init__(self, on_send=None):
+        self.sent = []
+        self.on_send = on_send
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+        if self.on_send:
+            self.on_send()
+
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+
+
+def test_sla_job_stops_when_leadership_is_lost_during_escalation(bot, make_record):
+    bot.is_leader = True
+    bot.users_roles[5] = 'technician'
+    now = int(time.time())
+    for app_id in ('1', '2'):
+        bot.applications[app_id] = make_record(app_id, created_at=now - 3600)
+    bot.sla_tracker.wheel = TimingWheel(now=now - 5)
+    for app in bot.applications.values():
+        bot.sla_tracker.refresh(app)
+
+    def lose_leadership():
+        # Так leader_election_job сбрасывает состояние лидера после ошибки хранилища
+        bot.is_leader = False
+        bot.sla_tracker.reset()
+
+    fake_bot = FakeBot(on_send=lose_leadership)
+    asyncio.run(bot.sla_job(FakeContext(fake_bot)))
+    assert len(fake_bot.sent) == 1
+    assert sorted(app.sla_level for app in bot.applications.values()) == [0, 1]
+
+
+def test_search_log_is_trimmed_up_to_the_slowest_reader(bot, make_record):
+    os.makedirs(bot.ARCHIVE_DIR)
+    bot.rebuild_search_index()
+    now = int(time.time())
+    # Заявку создал другой экземпляр, который еще не дочитал журнал; третий давно остановлен
+    bot.applications['1'] = make_record('1', problem='Сломан турникет')
+    bot.backend.append_log('search', '1')
+    bot.backend.log_readers['search:other'] = f'0 {now}'
+    bot.backend.log_readers['search:gone'] = f'0 {now - bot.SEARCH_READER_TTL - 1}'
+    bot.sync_search_index()
+    assert bot.search_index.search('турникет') == ['1']
+
+    bot.trim_search_log()
+    assert 'search:gone' not in bot.backend.log_readers
+    assert bot.backend.read_log('search', 0)[1] == ['1']
+    bot.backend.log_readers['search:other'] = f'{bot.search_log_offset} {now}'
+    bot.trim_search_log()
+    assert bot.backend.read_log('search', 0)[1] == []
+
+    # Отметку экземпляра удалили как устаревшую — он переиндексирует все текущие заявки
+    del bot.backend.log_readers[f'search:{bot.INSTANCE_ID}']
+    bot.applications['2'] = make_record('2', problem='Сломан валидатор')
+    bot.sync_search_index()
+    assert bot.search_index.search('сломан') == ['2', '1']
+
+
+def test_archiving_is_disabled_when_archive_dir_is_not_shared(bot, make_record):
+    os.makedirs(bot.ARCHIVE_DIR)
+    assert bot.check_archive_dir()
+    # Перезапуск с тем же каталогом
+    assert bot.check_archive_dir()
+
+    # Другая машина с общим хранилищем, но своим пустым каталогом архива
+    os.remove(bot.ARCHIVE_ID_PATH)
+    assert not bot.check_archive_dir()
+    assert not os.path.exists(bot.ARCHIVE_ID_PATH)
+    bot.is_leader = True
+    bot.applications['1'] = make_record('1', status=bot.AppStatus.RESOLVED, resolved_at=1_700_000_100)
+    asyncio.run(bot.archive_job(None))
+    assert '1' in bot.applications
+
+
+def archive_setup(bot, make_record):
+    os.makedirs(bot.ARCHIVE_DIR)
+    os.makedirs('photos')
+    bot.check_archive_dir()
+    bot.load_archive_index()
+    bot.rebuild_search_index()
+    resolved_at = 1_700_000_100
+    with open('photos/1.jpg', 'wb') as f:
+        f.write(b'jpeg')
+    bot.applications['1'] = make_record('1', serial='SN-7', status=bot.AppStatus.RESOLVED, resolved_at=resolved_at,
+                                        solution='Замена блока', photo='photos/1.jpg', photo_file_id='FILE1')
+    bot.applications['2'] = make_record('2', serial='SN-7', status=bot.AppStatus.RESOLVED, created_at=1_700_000_050,
+                                        resolved_at=resolved_at + bot.ARCHIVE_AFTER_DAYS * 24 * 3600)
+    bot.applications['3'] = make_record('3', serial='SN-8')
+    return resolved_at + bot.ARCHIVE_AFTER_DAYS * 24 * 3600 + 1
+
+
+def test_archiving_moves_old_resolved_applications(bot, make_record):
+    now = archive_setup(bot, make_record)
+    assert bot.archive_resolved_applications(now) == 1
+    assert sorted(bot.applications) == ['2', '3']
+    assert not os.path.exists('photos/1.jpg')
+
+    archived = bot.get_application('1')
+    assert archived.solution == 'Замена блока'
+    assert archived.photo is None and archived.photo_file_id == 'FILE1'
+    assert bot.backend.pop_queue('sheets', 10) == ['1']
+    # История и поиск находят заявку в архиве после сброса кеша и перезапуска
+    bot.archive_cache.clear()
+    assert [app.id for app in bot.find_applications('serial', 'SN-7')] == ['1', '2']
+    bot.search_index = bot.SearchIndex(bot.SEARCH_FIELD_WEIGHTS)
+    bot.rebuild_search_index()
+    assert bot.search_index.search('замена') == ['1']
+    assert bot.archive_resolved_applications(now) == 0
+
+
+def test_archiving_resumes_after_crash_without_duplicates(bot, make_record):
+    now = archive_setup(bot, make_record)
+    stale = bot.applications['1']
+    bot.archive_resolved_applications(now)
+    # Прошлый запуск упал после записи index.json, но до удаления заявки из хранилища
+    bot.applications['1'] = stale
+    assert [app.id for app in bot.find_applications('serial', 'SN-7')] == ['1', '2']
+    assert bot.archive_resolved_applications(now) == 1
+    assert '1' not in bot.applications
+    assert bot.archive_index['serial']['SN-7'] == ['1']
+    assert [app.id for app in bot.find_applications('serial', 'SN-7')] == ['1', '2']
+
+
+def test_coalesce_shares_one_call_between_concurrent_requests(bot):
+    calls = []
+
+    async def build():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return len(calls)
+
+    async def scenario():
+        first = asyncio.ensure_future(bot.coalesce('active', build))
+        second = asyncio.ensure_future(bot.coalesce('active', build))
+        third = asyncio.ensure_future(bot.coalesce('active', build))
+        await asyncio.sleep(0)
+        # Отмена одного ожидающего не отменяет общий запрос
+        first.cancel()
+        assert await asyncio.gather(second, third) == [1, 1]
+        assert bot.inflight_requests == {}
+        # Следующий запрос после завершения выполняется заново
+        assert await bot.coalesce('active', build) == 2
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+
+
+def make_update(update_id, user_id, text):
+    replies = []
+
+    async def reply_text(reply, **kwargs):
+        replies.append(reply)
+
+    message = SimpleNamespace(text=text, reply_text=reply_text)
+    update = SimpleNamespace(update_id=update_id, effective_user=SimpleNamespace(id=user_id),
+                             message=message, callback_query=None)
+    return update, replies
+
+
+def run_middleware(bot, update):
+    try:
+        asyncio.run(bot.rate_limit_middleware(update, None))
+    except ApplicationHandlerStop:
+        return False
+    return True
+
+
+def test_rate_limit_middleware_drops_repeats_and_limits_commands(bot):
+    update, _ = make_update(1, 5, '/roles')
+    assert run_middleware(bot, update)
+    # Повтор той же команды, пока не прошло COMMAND_DEDUP_WINDOW
+    update, replies = make_update(2, 5, '/roles')
+    assert not run_middleware(bot, update)
+    assert replies == []
+
+    capacity = bot.COMMAND_RATE_LIMITS['activeapplications'][0]
+    results, notices = [], []
+    for i in range(capacity + 2):
+        update, replies = make_update(10 + i, 5, f'/activeapplications {i}')
+        results.append(run_middleware(bot, update))
+        notices += replies
+    assert results == [True] * capacity + [False, False]
+    # Предупреждение о лимите — одно на RATE_LIMIT_NOTICE_INTERVAL
+    assert len(notices) == 1 and notices[0].startswith('⏳')
+    # Лимит команды не мешает другому пользователю
+    update, _ = make_update(100, 6, '/activeapplications')
+    assert run_middleware(bot, update)
+
+
+def test_error_digest_is_sent_once_by_the_leader(bot):
+    fake_bot = FakeBot()
+    # Ошибки другого экземпляра приходят через общую очередь
+    bot.report_error('Google Sheets, ошибка записи', 'sheets')
+    bot.report_error('Google Sheets, ошибка записи', 'sheets')
+    asyncio.run(bot.error_digest_job(FakeContext(fake_bot)))
+    assert fake_bot.sent == [] and bot.error_digest == {}
+
+    bot.is_leader = True
+    bot.report_error('Google Sheets, ошибка записи', 'sheets')
+    bot.report_error('Ошибка обработчика', 42)
+    asyncio.run(bot.error_digest_job(FakeContext(fake_bot)))
+    assert [chat_id for chat_id, _ in fake_bot.sent] == bot.ADMIN_IDS
+    text = fake_bot.sent[0][1]
+    assert 'Ошибок за последние' in text and ': 4' in text
+    assert '×3 Google Sheets, ошибка записи' in text
+    fake_bot.sent.clear()
+    asyncio.run(bot.error_digest_job(FakeContext(fake_bot)))
+    assert fake_bot.sent == []
+
+
+def test_error_digest_is_sent_directly_when_backend_fails(bot, monkeypatch):
+    def broken(*args):
+        raise ConnectionError('Redis недоступен')
+
+    monkeypatch.setattr(bot.backend, 'push_queue', broken)
+    fake_bot = FakeBot()
+    bot.report_error('Ошибка хранилища', 7)
+    asyncio.run(bot.error_digest_job(FakeContext(fake_bot)))
+    assert len(fake_bot.sent) == len(bot.ADMIN_IDS)
+    assert bot.error_digest == {}
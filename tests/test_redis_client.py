@@ -0,0 +1,68 @@
+import socketserver
+import threading
+
+import pytest
+
+from state import RedisClient, RedisError
+
+
+def test_reply_types(redis_server):
+    client = RedisClient('127.0.0.1', redis_server.port, db=1, password='secret')
+    assert client.execute('SET', 'key', 'значение') == 'OK'
+    assert client.execute('GET', 'key') == 'значение'
+    assert client.execute('GET', 'missing') is None
+    assert client.execute('INCR', 'counter') == 1
+    client.execute('RPUSH', 'list', 'a', 'b')
+    assert client.execute('LRANGE', 'list', 0, -1) == ['a', 'b']
+    with pytest.raises(RedisError):
+        client.execute('NOSUCHCOMMAND')
+    # После ошибки сервера соединение остается рабочим
+    assert client.execute('GET', 'key') == 'значение'
+    assert redis_server.store.commands[:2] == ['AUTH', 'SELECT']
+
+
+def test_resend_after_broken_connection(redis_server):
+    client = RedisClient('127.0.0.1', redis_server.port)
+    client.execute('SET', 'key', '1')
+    # Соединение оборвалось между командами: отправка не удалась, команду можно повторить
+    client.sock.close()
+    assert client.execute('INCR', 'key') == 2
+
+
+class ReadAndHangUp(socketserver.StreamRequestHandler):
+    """Принимает команду и закрывает соединение, не ответив"""
+
+    def handle(self):
+        self.rfile.readline()
+        self.server.received += 1
+
+
+def test_no_retry_when_reply_is_lost():
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), ReadAndHangUp)
+    server.received = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = RedisClient('127.0.0.1', server.server_address[1])
+        with pytest.raises(ConnectionError):
+            client.execute('INCR', 'counter')
+        # Сервер мог выполнить INCR: повтор увеличил бы счетчик дважды
+        assert server.received == 1
+        assert client.sock is None
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_transaction_detects_concurrent_write(redis_server):
+    client, other = (RedisClient('127.0.0.1', redis_server.port) for _ in range(2))
+    client.execute('SET', 'key', '1')
+
+    def build(call):
+        value = call('GET', 'key')
+        other.execute('SET', 'key', 'другое')
+        return [('SET', 'key', str(int(value) + 1))]
+
+    assert client.transaction(['key'], build) is None
+    assert client.execute('GET', 'key') == 'другое'
+    assert client.transaction(['key'], lambda call: [('SET', 'key', '3')]) == ['OK']
+    assert client.transaction(['key'], lambda call: []) == []
@@ -0,0 +1,49 @@
+from search import ArchiveSearchIndex, SearchIndex
+
+WEIGHTS = {'serial': 5, 'bus': 5, 'phone': 4, 'garage': 2, 'problem': 1, 'solution': 1}
+
+
+def test_search_ranks_fields_and_matches_prefix_and_substring(make_record):
+    index = SearchIndex(WEIGHTS)
+    index.add(make_record('1', serial='VAL-100', problem='Не работает терминал'))
+    index.add(make_record('2', serial='X1', bus='100 ABC 02', problem='Валидатор VAL-100 мигает'))
+    assert index.search('val 100') == ['1', '2']
+    # Номер без пробелов находится по подстроке
+    assert index.search('abc02') == ['2']
+    assert index.search('термин') == ['1']
+    assert index.search('терминал мигает') == []
+
+
+def test_reindex_and_remove(make_record):
+    index = SearchIndex(WEIGHTS)
+    app = make_record('1', problem='Сломан турникет')
+    index.add(app)
+    app.problem = 'Сломан валидатор'
+    index.add(app)
+    assert index.search('турникет') == []
+    assert index.search('валидатор') == ['1']
+    index.remove('1')
+    assert index.search('сломан') == []
+    assert index.postings == {} and index.trigrams == {}
+
+
+def test_archive_index_on_disk_merges_with_memory(make_record, tmp_path):
+    path = str(tmp_path / 'search.db')
+    archive = ArchiveSearchIndex(path, WEIGHTS)
+    archive.add_many([make_record('1', serial='VAL-100', problem='Не работает терминал'),
+                      make_record('2', serial='X1', bus='100 ABC 02', problem='Валидатор мигает')])
+    archive.close()
+
+    # После перезапуска архив читается с диска, а в памяти только текущие заявки
+    index = SearchIndex(WEIGHTS, archive=ArchiveSearchIndex(path, WEIGHTS))
+    index.add(make_record('3', serial='VAL-300', problem='Терминал не печатает'))
+    assert index.archive.indexed_ids() == {'1', '2'}
+    assert set(index.doc_tokens) == {'3'}
+    assert index.search('терминал') == ['3', '1']
+    assert index.search('abc02') == ['2']
+    assert index.search('val') == ['3', '1']
+    # Заявка, которая еще в памяти и уже в архиве, не дублируется
+    index.add(make_record('2', serial='X1', bus='100 ABC 02', problem='Валидатор мигает'))
+    assert index.search('мигает') == ['2']
+    index.archive.remove('1')
+    assert index.search('терминал') == ['3']
@@ -0,0 +1,182 @@
+import gspread
+from gspread.utils import a1_to_rowcol
+
+from sheets_sync import SHEET_COLUMNS, SheetsSync
+from state import AppStatus, create_backend
+
+
+class FakeWorksheet:
+    """Лист gspread в памяти, записывающий вызовы API"""
+
+    def __init__(self):
+        self.cells = []
+        self.calls = []
+
+    def set_cell(self, row, col, value):
+        while len(self.cells) < row:
+            self.cells.append([])
+        cells = self.cells[row - 1]
+        while len(cells) < col:
+            cells.append('')
+        cells[col - 1] = value
+
+    def get_all_values(self):
+        self.calls.append(('get_all_values',))
+        return [list(row) for row in self.cells]
+
+    def update(self, range_name, values):
+        self.calls.append(('update', range_name))
+        row, col = a1_to_rowcol(range_name)
+        for offset, value in enumerate(values[0]):
+            self.set_cell(row, col + offset, value)
+
+    def batch_update(self, data, **kwargs):
+        self.calls.append(('batch_update', [item['range'] for item in data]))
+        for item in data:
+            row, col = a1_to_rowcol(item['range'].split(':')[0])
+            for offset, value in enumerate(item['values'][0]):
+                self.set_cell(row, col + offset, value)
+
+    def append_rows(self, rows, **kwargs):
+        self.calls.append(('append_rows', len(rows)))
+        first = len(self.cells) + 1
+        for i, values in enumerate(rows):
+            for j, value in enumerate(values):
+                self.set_cell(first + i, j + 1, value)
+        return {'updates': {'updatedRange': f"'Заявки'!A{first}:N{first + len(rows) - 1}"}}
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.sheet = None
+        self.revision = 0
+        self.revision_reads = 0
+
+    def worksheet(self, name):
+        if self.sheet is None:
+            raise gspread.WorksheetNotFound(name)
+        return self.sheet
+
+    def add_worksheet(self, name, rows, cols):
+        self.sheet = FakeWorksheet()
+        return self.sheet
+
+    def get_lastUpdateTime(self):
+        self.revision_reads += 1
+        return str(self.revision)
+
+
+def make_sync(make_record, count=3):
+    backend = create_backend('memory')
+    for i in range(1, count + 1):
+        backend.applications[str(i)] = make_record(str(i), serial=f'SN-{i}')
+    spreadsheet = FakeSpreadsheet()
+    return SheetsSync(lambda: spreadsheet, backend, 'Заявки'), spreadsheet, backend
+
+
+def test_push_appends_new_rows_in_one_request(make_record):
+    sync, spreadsheet, backend = make_sync(make_record)
+    assert sync.push(list(backend.applications.values())) == 1
+    sheet = spreadsheet.sheet
+    assert sheet.calls == [('get_all_values',), ('update', 'A1'), ('append_rows', 3)]
+    assert sheet.cells[0] == [header for header, _ in SHEET_COLUMNS]
+    assert sync.row_index == {'1': 2, '2': 3, '3': 4}
+    assert sheet.cells[3][3] == 'SN-3'
+
+
+def test_push_sends_changed_cells_as_merged_ranges(make_record):
+    sync, spreadsheet, backend = make_sync(make_record)
+    apps = list(backend.applications.values())
+    sync.push(apps)
+    sheet = spreadsheet.sheet
+    sheet.calls.clear()
+
+    # Принята (C) и Техник (M) — отдельными диапазонами, соседние Статус, Решение, Решена — одним I:K
+    apps[0].status, apps[0].accepted_at = AppStatus.RESOLVED, 1_700_000_100
+    apps[0].solution, apps[0].resolved_at, apps[0].technician_name = 'Перезагрузка', 1_700_000_200, 'Техник'
+    apps[2].problem = 'Новая проблема'
+    new = make_record('4')
+    assert sync.push(apps + [new]) == 2
+    assert sheet.calls == [
+        ('batch_update', ['C2:C2', 'I2:K2', 'M2:M2', 'H4:H4']),
+        ('append_rows', 1),
+    ]
+    assert sheet.cells[1][9] == 'Перезагрузка'
+    # Без изменений запросов нет
+    assert sync.push(apps + [new]) == 0
+
+
+def test_pull_skips_reading_when_revision_is_unchanged(make_record):
+    sync, spreadsheet, backend = make_sync(make_record)
+    sync.push(list(backend.applications.values()))
+    sheet = spreadsheet.sheet
+    revision_reads = spreadsheet.revision_reads
+
+    assert sync.pull() == []
+    reads = sheet.calls.count(('get_all_values',))
+    assert sync.pull() == []
+    assert sync.pull() == []
+    assert sheet.calls.count(('get_all_values',)) == reads
+    assert spreadsheet.revision_reads == revision_reads + 3
+
+    # Правка в таблице меняет ревизию и переносится только в отредактированное поле
+    sheet.cells[2][7] = 'Исправлено в таблице'
+    spreadsheet.revision += 1
+    backend.update_application('2', lambda app: setattr(app, 'status', AppStatus.IN_PROGRESS) or True)
+    changed = sync.pull()
+    assert [app.id for app in changed] == ['2']
+    stored = backend.applications['2']
+    assert stored.problem == 'Исправлено в таблице'
+    assert stored.status is AppStatus.IN_PROGRESS
+    assert sheet.calls.count(('get_all_values',)) == reads + 1
+
+
+def test_push_rereads_sheet_after_rows_were_deleted(make_record):
+    sync, spreadsheet, backend = make_sync(make_record)
+    sync.push(list(backend.applications.values()))
+    sheet = spreadsheet.sheet
+
+    # Строку заявки 1 удалили в таблице: строки 2 и 3 сдвинулись вверх
+    del sheet.cells[1]
+    spreadsheet.revision += 1
+    backend.update_application('3', lambda app: setattr(app, 'problem', 'Новая проблема') or True)
+    sync.push([backend.applications['1'], backend.applications['3']])
+    assert [row[0] for row in sheet.cells] == ['ID', '2', '3', '1']
+    assert sheet.cells[2][7] == 'Новая проблема'
+    assert sync.pull() == []
+    assert backend.applications['3'].problem == 'Новая проблема'
+
+
+def test_sheet_edits_survive_reset(make_record):
+    sync, spreadsheet, backend = make_sync(make_record)
+    sync.push(list(backend.applications.values()))
+    sheet = spreadsheet.sheet
+
+    # Правку сделали, пока таблица была недоступна; новый лидер начинает с чистого объекта
+    sheet.cells[1][7] = 'Исправлено в таблице'
+    spreadsheet.revision += 1
+    sync.reset()
+    other = SheetsSync(lambda: spreadsheet, backend, 'Заявки')
+    other.push([backend.applications['2']])
+    assert backend.applications['1'].problem == 'Исправлено в таблице'
+    assert [app.id for app in other.pull()] == ['1']
+    assert sheet.cells[1][7] == 'Исправлено в таблице'
+
+
+def test_solution_of_open_application_is_not_edited_from_sheet(make_record):
+    sync, spreadsheet, backend = make_sync(make_record)
+    backend.update_application('1', lambda app: app.transition(AppStatus.IN_PROGRESS) or True)
+    sync.push(list(backend.applications.values()))
+    sheet = spreadsheet.sheet
+
+    sheet.cells[1][9] = 'Решение из таблицы'
+    sheet.cells[1][7] = 'Исправлено в таблице'
+    spreadsheet.revision += 1
+    assert [app.id for app in sync.pull()] == ['1']
+    stored = backend.applications['1']
+    assert stored.solution is None
+    assert stored.problem == 'Исправлено в таблице'
+    # Бот возвращает свое значение в ячейку при следующей выгрузке
+    assert backend.pop_queue('sheets', 10) == ['1']
+    sync.push([stored])
+    assert sheet.cells[1][9] == ''
@@ -0,0 +1,68 @@
+import math
+import random
+import time
+
+from sla import SLATracker, TimingWheel
+from state import AppStatus
+
+
+def test_wheel_matches_brute_force():
+    rng = random.Random(31)
+    for _ in range(20):
+        start = rng.randrange(0, 10 ** 6)
+        wheel = TimingWheel(slots=8, levels=3, now=start)  # горизонт 512 тиков, дальше — перекладывание
+        expected = {}  # {ключ: тик срабатывания}
+        now = start
+        for _ in range(300):
+            action = rng.random()
+            if action < 0.5:
+                key = rng.randrange(50)
+                deadline = now + rng.choice([rng.uniform(-5, 10), rng.uniform(0, 600), rng.uniform(0, 5000)])
+                wheel.schedule(key, deadline, deadline)
+                expected[key] = max(math.ceil(deadline), now + 1)
+            elif action < 0.6 and expected:
+                key = rng.choice(list(expected))
+                assert wheel.cancel(key)
+                del expected[key]
+            else:
+                now += rng.choice([1, rng.randrange(1, 70), rng.randrange(1, 3000)])
+                fired = wheel.advance(now)
+                due = {key for key, tick in expected.items() if tick <= now}
+                assert {key for key, _ in fired} == due
+                # Таймер срабатывает в порядке сроков и не раньше своего срока
+                ticks = [expected[key] for key, _ in fired]
+                assert ticks == sorted(ticks)
+                for key in due:
+                    del expected[key]
+            assert len(wheel) == len(expected)
+
+
+def test_wheel_skips_empty_ticks_quickly():
+    wheel = TimingWheel(now=0)
+    for i in range(100):
+        wheel.schedule(i, 50_000 * i + 7)
+    started = time.perf_counter()
+    fired = wheel.advance(5_000_000)
+    assert time.perf_counter() - started < 0.5
+    assert [key for key, _ in fired] == list(range(100))
+    assert wheel.current == 5_000_000
+
+
+def test_tracker_escalation_steps(make_record):
+    applications = {'1': make_record('1', created_at=1000, garage='Парк 2')}
+    tracker = SLATracker(applications, {'accept': 300, 'resolve': 3600}, levels=3)
+    tracker.thresholds['garages'] = {'Парк 2': {'accept': 60}}
+    tracker.wheel = TimingWheel(now=1000)
+    tracker.refresh(applications['1'])
+
+    assert tracker.due(1059) == []
+    assert [(app.id, phase, level) for app, phase, level in tracker.due(1060)] == [('1', 'accept', 0)]
+
+    # Заявку приняли до следующей ступени: срок принятия больше не действует
+    app = applications['1']
+    app.sla_level = 1
+    tracker.refresh(app)
+    app.status, app.accepted_at, app.sla_level = AppStatus.IN_PROGRESS, 1100, 0
+    assert tracker.due(1120) == []
+    tracker.refresh(app)
+    assert [(phase, level) for _, phase, level in tracker.due(1100 + 3600)] == [('resolve', 0)]
@@ -0,0 +1,239 @@
+import json
+import threading
+import time
+
+import pytest
+
+from state import AppStatus, InvalidTransition, create_backend, record_from_dict, record_to_dict
+
+
+def test_transition_rejects_invalid_status_change(make_record):
+    app = make_record('1')
+    with pytest.raises(InvalidTransition):
+        app.transition(AppStatus.RESOLVED)
+    assert app.status is AppStatus.ACTIVE
+    app.transition(AppStatus.IN_PROGRESS)
+    app.transition(AppStatus.UNRESOLVED)
+    # Закрытую заявку нельзя вернуть в работу
+    with pytest.raises(InvalidTransition):
+        app.transition(AppStatus.IN_PROGRESS)
+
+
+def test_record_round_trip_through_archive_format(make_record):
+    app = make_record('7', status=AppStatus.RESOLVED, outcome=AppStatus.RESOLVED, technician_id=5,
+                      technician_name='Техник', accepted_at=1_700_000_100, solution='Замена блока',
+                      photo_file_id='FILE7', resolved_at=1_700_000_900, sla_level=2)
+    data = json.loads(json.dumps(record_to_dict(app), ensure_ascii=False))
+    assert data['status'] == 'resolved'
+    assert record_from_dict(data) == app
+    # Поля, удаленные из модели, в старых архивных записях пропускаются
+    data['removed_field'] = 'x'
+    restored = record_from_dict(data)
+    assert restored.status is AppStatus.RESOLVED and restored.outcome is AppStatus.RESOLVED
+
+
+def test_update_application_is_visible_to_other_instance(backends, make_record):
+    first, second = backends
+    first.applications['1'] = make_record('1')
+
+    def accept(app):
+        app.transition(AppStatus.IN_PROGRESS)
+        app.technician_id = 5
+        return True
+
+    updated = first.update_application('1', accept)
+    assert updated.status is AppStatus.IN_PROGRESS
+    assert second.applications['1'].technician_id == 5
+
+
+def test_update_application_rejected_mutation_is_not_saved(backends, make_record):
+    first, second = backends
+    first.applications['1'] = make_record('1')
+
+    def reject(app):
+        app.solution = 'частичное изменение'
+        return False
+
+    assert first.update_application('1', reject) is None
+    assert second.applications['1'].solution is None
+    assert first.update_application('missing', lambda app: True) is None
+
+
+def test_redis_update_retries_after_concurrent_write(redis_server, make_record):
+    url = f'redis://127.0.0.1:{redis_server.port}/0'
+    first, second = create_backend(url), create_backend(url)
+    first.applications['1'] = make_record('1', status=AppStatus.IN_PROGRESS, technician_id=5)
+    seen_outcomes = []
+
+    def set_solution(app):
+        if not seen_outcomes:
+            # Пока первый экземпляр читал заявку, второй записал в нее итог
+            second.update_application('1', lambda other: setattr(other, 'outcome', AppStatus.RESOLVED) or True)
+        seen_outcomes.append(app.outcome)
+        app.solution = 'Заменен блок питания'
+        return True
+
+    first.update_application('1', set_solution)
+    assert seen_outcomes == [None, AppStatus.RESOLVED]
+    stored = second.applications['1']
+    assert stored.solution == 'Заменен блок питания'
+    assert stored.outcome is AppStatus.RESOLVED
+
+
+def test_only_one_technician_accepts(backends, make_record):
+    first, second = backends
+    if first is second:
+        pytest.skip('в памяти процесса заявки меняются только из цикла событий')
+    first.applications['1'] = make_record('1')
+    winners = []
+
+    def accept_as(technician_id, backend):
+        def accept(app):
+            if app.status is not AppStatus.ACTIVE:
+                return False
+            app.transition(AppStatus.IN_PROGRESS)
+            app.technician_id = technician_id
+            return True
+        if backend.update_application('1', accept) is not None:
+            winners.append(technician_id)
+
+    threads = [threading.Thread(target=accept_as, args=(tech_id, backend))
+               for tech_id, backend in ((5, first), (6, second), (7, first), (8, second))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(winners) == 1
+    assert second.applications['1'].technician_id == winners[0]
+
+
+def test_stats_are_shared_between_instances(backends):
+    first, second = backends
+    first.incr_stats({'created': 1, 'accept_minutes': 2.5})
+    second.incr_stats({'created': 1, 'accept_minutes': 0.5, 'created:dispatcher:10': 1})
+    assert first.get_stats() == {'created': 2, 'accept_minutes': 3.0, 'created:dispatcher:10': 1}
+
+
+def test_log_is_read_by_every_instance(backends):
+    first, second = backends
+    first.append_log('search', '1')
+    offset, items = second.read_log('search', 0)
+    assert items == ['1']
+    second.append_log('search', '2')
+    first.append_log('other', 'x')
+    assert second.read_log('search', offset)[1] == ['2']
+    assert first.read_log('search', 0)[1] == ['1', '2']
+    # Очередь, в отличие от журнала, отдает запись только одному читателю
+    first.push_queue('sheets', '1')
+    assert second.pop_queue('sheets', 10) == ['1']
+    assert first.pop_queue('sheets', 10) == []
+
+
+def test_log_trim_keeps_positions(backends):
+    first, second = backends
+    for value in ('1', '2', '3'):
+        first.append_log('search', value)
+    end = second.log_end('search')
+    offset, items = second.read_log('search', 0)
+    assert (offset, items) == (end, ['1', '2', '3'])
+    first.append_log('other', 'x')
+    first.append_log('search', '4')
+    second.trim_log('search', offset)
+    assert first.read_log('search', offset) == (second.log_end('search'), ['4'])
+    assert first.read_log('other', 0)[1] == ['x']
+    # Конец журнала не сдвигается назад, даже если все записи удалены
+    end = first.log_end('search')
+    first.trim_log('search', end)
+    assert second.log_end('search') == end
+    assert second.read_log('search', end) == (end, [])
+    first.append_log('search', '5')
+    assert second.read_log('search', end)[1] == ['5']
+
+
+def test_application_ids_are_unique_across_instances(backends):
+    first, second = backends
+    first.ensure_counter(41)
+    ids = [first.next_application_id(), second.next_application_id(), first.next_application_id()]
+    assert ids == [42, 43, 44]
+    # Счетчик не уменьшается, если архив старее хранилища
+    second.ensure_counter(10)
+    assert second.next_application_id() == 45
+
+
+def test_ensure_counter_is_applied_once_when_instances_start_together(backends):
+    first, second = backends
+    if first is second:
+        pytest.skip('в памяти процесса запускается один экземпляр')
+    threads = [threading.Thread(target=backend.ensure_counter, args=(100,))
+               for backend in (first, second, first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert first.next_application_id() == 101
+
+
+def test_lease_has_one_owner_until_it_expires(backends):
+    first, second = backends
+    assert first.acquire_lease('leader', 'A', 0.2)
+    assert not second.acquire_lease('leader', 'B', 0.2)
+    # Владелец продлевает аренду
+    assert first.acquire_lease('leader', 'A', 0.2)
+    time.sleep(0.3)
+    assert second.acquire_lease('leader', 'B', 0.2)
+    assert not first.acquire_lease('leader', 'A', 0.2)
+
+
+def test_queue_is_fifo_and_respects_limit(backends):
+    first, second = backends
+    for value in ('1', '2', '3'):
+        first.push_queue('sla', value)
+    assert second.pop_queue('sla', 2) == ['1', '2']
+    assert first.pop_queue('sla', 2) == ['3']
+    assert first.pop_queue('sla', 2) == []
+
+
+def test_mappings_are_shared(backends, make_record):
+    first, second = backends
+    first.users_roles[5] = 'technician'
+    first.current_applications[5] = '1'
+    first.applications['1'] = make_record('1')
+    assert dict(second.users_roles.items()) == {5: 'technician'}
+    assert second.current_applications[5] == '1'
+    assert 5 in second.users_roles and 6 not in second.users_roles
+    assert [app.id for app in second.applications.values()] == ['1']
+    del second.current_applications[5]
+    assert first.current_applications.get(5) is None
+    with pytest.raises(KeyError):
+        del first.current_applications[5]
+
+
+def test_token_bucket_is_shared(backends):
+    first, second = backends
+    assert first.take_token('user:5', 2, 1) == 0
+    assert second.take_token('user:5', 2, 1) == 0
+    wait = first.take_token('user:5', 2, 1)
+    assert 0 < wait <= 1
+    # Корзины разных ключей независимы
+    assert second.take_token('user:6', 2, 1) == 0
+    time.sleep(wait + 0.05)
+    assert second.take_token('user:5', 2, 1) == 0
+
+
+def test_short_leases_deduplicate(backends):
+    first, second = backends
+    assert first.acquire_lease('dedup:5:/roles', 'A:1', 0.2)
+    assert not second.acquire_lease('dedup:5:/roles', 'B:2', 0.2)
+    time.sleep(0.25)
+    assert second.acquire_lease('dedup:5:/roles', 'B:3', 0.2)
+
+
+def test_expiring_values_are_shared_until_ttl(backends):
+    first, second = backends
+    first.put_expiring('search:abc', 'валидатор', 0.2)
+    assert second.get_expiring('search:abc') == 'валидатор'
+    assert second.get_expiring('search:other') is None
+    time.sleep(0.25)
+    assert first.get_expiring('search:abc') is None
+    second.put_expiring('search:abc', 'турникет', 0.2)
+    assert first.get_expiring('search:abc') == 'турникет'